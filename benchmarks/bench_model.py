@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Memory used by the Category/Media model for a big synthetic catalog
+
+Every model is built in its own process, so the peak RSS numbers don't
+mix. "legacy" is the model with a __dict__ per object, as it was before
+it got slots, "current" is the one from jwlib.parse.
+
+    python3 benchmarks/bench_model.py [--media N] [--per-category N]
+"""
+import argparse
+import gc
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class LegacyCategory:
+    iscategory = True
+    key = None
+    name = None
+    home = False
+    position = 0
+
+    def __init__(self):
+        self.content = []
+
+    def add(self, obj):
+        self.content.append(obj)
+
+
+class LegacyMedia:
+    iscategory = False
+    key = None
+    url = None
+    name = None
+    md5 = None
+    date = None
+    size = None
+    file = None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def build(category_class, media_class, n_media, per_category):
+    """Build a catalog like a crawl does, from freshly decoded strings
+
+    Strings are built with format(), so equal values are separate objects,
+    just like they are when they come out of json.loads().
+    """
+    result = []
+    cat = None
+    for i in range(n_media):
+        if i % per_category == 0:
+            cat = category_class()
+            cat.key = 'VODCategory{}'.format(i // per_category % 200)
+            cat.name = 'Category {}'.format(i // per_category)
+            result.append(cat)
+        m = media_class()
+        m.key = 'pub-jwb_{}_1_VIDEO'.format(i)
+        m.name = 'Video number {}'.format(i)
+        m.url = 'https://download-a.akamaihd.net/files/media_other/{:02x}/jwb_{}_E_r720P.mp4'.format(i % 256, i)
+        m.md5 = '{:032x}'.format(i * 2654435761)
+        m.date = 1500000000.0 + i
+        m.size = 10000000 + i
+        cat.add(m)
+    return result
+
+
+def child(model, n_media, per_category):
+    if model == 'legacy':
+        category_class, media_class = LegacyCategory, LegacyMedia
+    else:
+        from jwlib.parse import Category as category_class, Media as media_class
+
+    gc.collect()
+    base_rss = peak_rss()
+    base_objects = len(gc.get_objects())
+    start = time.perf_counter()
+    result = build(category_class, media_class, n_media, per_category)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    objects = len(gc.get_objects()) - base_objects
+    # Reading every URL back shows what the property costs
+    start = time.perf_counter()
+    for cat in result:
+        for m in cat.content:
+            m.url
+    read_time = time.perf_counter() - start
+    print(model, peak_rss() - base_rss, objects, elapsed, read_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--media', type=int, default=500000, help='number of Media objects')
+    parser.add_argument('--per-category', type=int, default=100, help='Media per Category')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.media, args.per_category)
+        return
+
+    print('{} media in {} categories'.format(args.media, -(-args.media // args.per_category)))
+    print('{:<8} {:>12} {:>14} {:>10} {:>12}'.format('model', 'peak RSS MiB', 'tracked objs', 'build s', 'read urls s'))
+    for model in ('legacy', 'current'):
+        out = subprocess.run([sys.executable, __file__, '--child', model,
+                              '--media', str(args.media), '--per-category', str(args.per_category)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        rss, objects, build_time, read_time = int(out[1]), int(out[2]), float(out[3]), float(out[4])
+        print('{:<8} {:>12.1f} {:>14} {:>10.2f} {:>12.2f}'.format(model, rss / 1024**2, objects, build_time, read_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Crawl and download throughput, measured against a local stand-in server
+
+A local HTTP server plays the mediator API, GETPUBMEDIALINKS and the media
+servers, with a synthetic catalog of the requested size. The real code
+runs end to end against it, and every stage is reported in requests/s,
+MB/s and wall time. No network access is needed.
+
+    python3 benchmarks/bench_offline.py [--categories N] [--media N] [--size KiB] ...
+"""
+import argparse
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from jwlib.client import client  # noqa: E402
+from jwlib.languages import catalog  # noqa: E402
+from jwlib.parse import JWBroadcasting, JWPubMedia  # noqa: E402
+
+LANG = 'E'
+
+
+class Catalog:
+    """Synthetic API responses
+
+    All media files have the same content, so one blob (and MD5) serves them all.
+    """
+
+    def __init__(self, base, categories, media, size, chapters):
+        """
+        :param base: URL of the server
+        :param categories: number of subcategories under the root category
+        :param media: number of media per subcategory
+        :param size: size of every media file in bytes
+        :param chapters: number of chapters per Bible book
+        """
+        self.base = base
+        self.categories = categories
+        self.media = media
+        self.chapters = chapters
+        # Not random, so runs are comparable
+        self.blob = (hashlib.sha256(b'jw-scripts').digest() * (size // 32 + 1))[:size]
+        self.md5 = hashlib.md5(self.blob).hexdigest()
+
+    def _file(self, name):
+        return {'progressiveDownloadURL': '{}/media/{}_r720P.mp4'.format(self.base, name),
+                'checksum': self.md5,
+                'filesize': len(self.blob),
+                'label': '720p',
+                'frameHeight': 720,
+                'subtitled': False}
+
+    def category(self, key):
+        if key == 'VideoOnDemand':
+            subcategories = [{'key': 'Bench{}'.format(i), 'name': 'Bench {}'.format(i)}
+                             for i in range(self.categories)]
+            return {'category': {'key': key, 'name': 'Video on Demand', 'subcategories': subcategories}}
+        if not key.startswith('Bench'):
+            return {'status': '404'}
+        n = int(key[5:])
+        media = [{'title': 'Video {}-{}'.format(n, i),
+                  'naturalKey': 'bench_{}_{}'.format(n, i),
+                  # Spread over 2000-2027, so the newest first order means something
+                  'firstPublished': '{}-01-01T00:00:00.000Z'.format(2000 + (n * self.media + i) % 28),
+                  'files': [self._file('bench_{}_{}'.format(n, i))]}
+                 for i in range(self.media)]
+        return {'category': {'key': key, 'name': 'Bench {}'.format(n), 'media': media}}
+
+    def pubmedia(self, query):
+        book = int(query.get('booknum', 0))
+        lang = query.get('langwritten', LANG)
+        files = [{'title': 'Book {} chapter {}'.format(book, c),
+                  'label': '720p',
+                  'mimetype': 'video/mp4',
+                  'filesize': len(self.blob),
+                  'file': {'url': '{}/media/nwt_{:02}_{:03}_r720P.mp4'.format(self.base, book, c),
+                           'checksum': self.md5}}
+                 for c in range(1, self.chapters + 1)]
+        response = {'pubName': 'Book {}'.format(book), 'files': {lang: {'MP4': files}}}
+        if query.get('alllangs') == '1':
+            response['languages'] = {LANG: {'name': 'English'}}
+        return response
+
+    def languages(self):
+        return {'languages': [{'code': LANG, 'name': 'English'}]}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+    def add(self, n):
+        with self.lock:
+            self.requests += 1
+            self.bytes += n
+
+    def snapshot(self):
+        with self.lock:
+            return self.requests, self.bytes
+
+
+def make_server(catalog_args, latency):
+    stats = Stats()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            parts = url.path.strip('/').split('/')
+            if parts[0] == 'media':
+                self.send_blob()
+                return
+            if latency:
+                time.sleep(latency)
+            if parts[0] == 'GETPUBMEDIALINKS':
+                data = api.pubmedia(query)
+            elif parts[:3] == ['mediator', 'v1', 'languages']:
+                data = api.languages()
+            elif parts[:3] == ['mediator', 'v1', 'categories']:
+                data = api.category(parts[4])
+            else:
+                self.send_error(404)
+                return
+            self.send(200, json.dumps(data).encode(), 'application/json')
+
+        def send_blob(self):
+            data = api.blob
+            status = 200
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                start, end = byte_range.split('=')[1].split('-')
+                start, end = int(start), int(end) if end else len(data) - 1
+                data = data[start:end + 1]
+                status = 206
+            self.send(status, data, 'video/mp4', byte_range and 'bytes {}-{}/{}'.format(
+                start, start + len(data) - 1, len(api.blob)))
+
+        def send(self, status, data, content_type, content_range=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            if content_range:
+                self.send_header('Content-Range', content_range)
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            stats.add(len(data))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    api = Catalog(base, **catalog_args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base, stats
+
+
+def quiet_stdout(func):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return func()
+
+
+def run_stage(name, stats, func):
+    requests, served = stats.snapshot()
+    start = time.perf_counter()
+    result = func()
+    wall = time.perf_counter() - start
+    requests, served = stats.snapshot()[0] - requests, stats.snapshot()[1] - served
+    print('{:<22} {:>9.2f} {:>9} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+        name, wall, requests, requests / wall, served / 1e6, served / 1e6 / wall), flush=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--categories', type=int, default=20, help='subcategories in the catalog')
+    parser.add_argument('--media', type=int, default=50, help='media per subcategory')
+    parser.add_argument('--size', type=int, default=256, help='size of each media file in KiB')
+    parser.add_argument('--chapters', type=int, default=5, help='chapters per Bible book')
+    parser.add_argument('--latency', type=float, default=0, help='delay of every API response in ms')
+    parser.add_argument('--jobs', type=int, default=8, help='parallel API requests')
+    parser.add_argument('--streams', type=int, default=4, help='files downloaded at the same time')
+    parser.add_argument('--segments', type=int, default=1, help='connections per file')
+    parser.add_argument('--work-dir', help='download here instead of a temporary directory (kept)')
+    parser.add_argument('--verbose', action='store_true', help='show the messages from jw-scripts')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # The modules hold on to sys.stderr, so silence the file descriptor
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+    server, base, stats = make_server({'categories': args.categories,
+                                       'media': args.media,
+                                       'size': args.size * 1024,
+                                       'chapters': args.chapters},
+                                      args.latency / 1000)
+    tmp = tempfile.mkdtemp(prefix='jw-bench-')
+    wd = args.work_dir or os.path.join(tmp, 'media')
+    catalog.url = base + '/mediator/v1/languages/E/web'
+    catalog.path = os.path.join(tmp, 'languages.json')
+    client.pool.maxsize = max(client.pool.maxsize, args.jobs, args.streams * args.segments)
+
+    def setup(obj):
+        obj.mediator_url = base + '/mediator/v1'
+        obj.pubmedia_url = base + '/GETPUBMEDIALINKS'
+        obj.quiet = 2
+        obj.cache = False
+        obj.jobs = args.jobs
+        obj.streams = args.streams
+        obj.segments = args.segments
+        # Every file is over the threshold when segments are wanted
+        obj.segment_threshold = 1 if args.segments > 1 else obj.segment_threshold
+        obj.rate_limit = '0'
+        obj.work_dir = wd
+        obj.download = True
+        obj.checksums = True
+        obj.type = 'video'
+        obj.lang = LANG
+        return obj
+
+    print('{} categories x {} media of {} KiB, {} ms latency, {} jobs, {} streams, {} segments'.format(
+        args.categories, args.media, args.size, args.latency, args.jobs, args.streams, args.segments))
+    print('{:<22} {:>9} {:>9} {:>10} {:>10} {:>10}'.format('stage', 'wall s', 'requests', 'req/s', 'MB', 'MB/s'))
+    try:
+        jwb = setup(JWBroadcasting())
+        run_stage('JWBroadcasting.parse', stats, jwb.parse)
+        run_stage('prepare_download', stats, jwb.prepare_download)
+        run_stage('manage_downloads', stats, jwb.manage_downloads)
+        # Everything is on disk now, so this only checks files
+        jwb = setup(JWBroadcasting())
+        jwb.parse()
+        run_stage('prepare_download again', stats, jwb.prepare_download)
+
+        jwp = setup(JWPubMedia())
+        jwp.pub = 'nwt'
+        jwp.book = 0
+        jwp.work_dir = os.path.join(wd, 'nwt')
+        # parse() prints to stdout
+        run_stage('JWPubMedia.parse', stats, lambda: quiet_stdout(jwp.parse))
+        run_stage('pub downloads', stats, lambda: (jwp.prepare_download(), jwp.manage_downloads()))
+
+        jwb = setup(JWBroadcasting())
+        jwb.work_dir = os.path.join(wd, 'pipeline')
+        run_stage('pipeline_downloads', stats, jwb.pipeline_downloads)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
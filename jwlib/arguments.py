@@ -1,6 +1,6 @@
 from os import makedirs
 from shutil import disk_usage
-from sys import stderr
+from sys import stderr, stdin
 from argparse import SUPPRESS
 
 
@@ -51,16 +51,69 @@ valid_args = {
         'action': 'store_true',
         'dest': 'checksums',
         'help': 'check md5 checksum'},
+    '--rehash': {
+        'action': 'store_true',
+        'help': 'check md5 checksum of all files, also those checked before (implies --checksum)'},
     '--no-checksum': {
         'action': 'store_false',
         'dest': 'checksums',
         'help': 'don\'t check md5 checksum'},
+    '--cache-dir': {
+        'metavar': 'DIR',
+        'dest': 'cache_dir',
+        'help': 'directory to cache API responses in'},
+    '--cache-ttl': {
+        'default': 0,
+        'type': int,
+        'metavar': 'SECONDS',
+        'dest': 'cache_ttl',
+        'help': 'use cached API responses this long without revalidating them'},
+    '--no-cache': {
+        'action': 'store_false',
+        'dest': 'cache',
+        'help': 'always download API responses again'},
     '--free': {
         'default': 0,
         'type': int,
         'metavar': 'MiB',
         'dest': 'keep_free',
-        'help': 'disk space in MiB to keep free (deletes older MP4 files)'},
+        'help': 'disk space in MiB to keep free (deletes older media files)'},
+    '--jobs': {
+        'alternatives': ['-j'],
+        'default': 1,
+        'type': int,
+        'metavar': 'N',
+        'help': 'number of parallel jobs'},
+    '--streams': {
+        'default': 1,
+        'type': int,
+        'metavar': 'N',
+        'help': 'number of files to download at the same time'},
+    '--segments': {
+        'default': 1,
+        'type': int,
+        'metavar': 'N',
+        'help': 'number of connections per file, for files over 64 MiB'},
+    '--metrics': {
+        'metavar': 'FILE',
+        'dest': 'metrics_file',
+        'help': 'write metrics to FILE at exit, as JSON if it ends with .json, else as a Prometheus textfile'},
+    '--resume-queue': {
+        'action': 'store_true',
+        'help': 'download what is left from an interrupted run, without indexing again'},
+    '--pipeline': {
+        'action': 'store_true',
+        'help': 'start downloading while still indexing (newest first order is lost)'},
+    '--timeout': {
+        'default': 30,
+        'type': float,
+        'metavar': 'SEC',
+        'help': 'network timeout in seconds'},
+    '--retries': {
+        'default': 3,
+        'type': int,
+        'metavar': 'N',
+        'help': 'number of times to retry failed requests'},
     '--no-warning': {
         'dest': 'warn',
         'action': 'store_false',
@@ -114,6 +167,9 @@ def disk_usage_info(wd, keep_free: int, warn=True, quiet=0):
               'If the limit was set too high, many or ALL videos may get deleted.\n' \
               'Press Enter to proceed or Ctrl+D to abort... '
         print(msg.format((keep_free-free) // 1024**2), file=stderr)
+        if not stdin.isatty():
+            # Nobody there to answer, like when run by cron
+            return
         try:
             input()
         except EOFError:
@@ -0,0 +1,38 @@
+import os
+import json
+import threading
+
+
+def atomic_write(path, data, fsync=False):
+    """Replace the content of a file in one go
+
+    The data goes to a temporary file next to it, which is then renamed
+    over the file, so readers see either the old or the new content, never
+    half of it.
+
+    :param path: file to write
+    :param data: str (written as UTF-8) or bytes
+    :param fsync: make sure the data is on disk before the rename
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    # Unique per thread, for files written by several threads
+    tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_write_json(path, obj, **kwargs):
+    """Like :func:`atomic_write`, with obj encoded by json.dumps(obj, **kwargs)"""
+    atomic_write(path, json.dumps(obj, **kwargs))
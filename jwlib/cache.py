@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib.error
+
+from jwlib.atomic import atomic_write_json
+from jwlib.client import urlopen
+from jwlib.metrics import metrics
+
+pj = os.path.join
+
+_lookups = metrics.counter('jw_cache_lookups_total', 'API response cache lookups, by result')
+
+
+def default_cache_dir():
+    """Return the directory where cached data is kept by default"""
+    base = os.environ.get('XDG_CACHE_HOME') or pj(os.path.expanduser('~'), '.cache')
+    return pj(base, 'jw-scripts')
+
+
+class ResponseCache:
+    """Keep API responses on disk, keyed by URL
+
+    Entries younger than :var:`ttl` seconds are returned straight from disk.
+    Older entries are revalidated with the ETag or Last-Modified header
+    the server sent, so an unchanged response costs a 304 instead of a full
+    payload. When the cache grows over :var:`max_size` bytes, the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, directory, ttl=0, max_size=64 * 1024**2):
+        """
+        :param directory: where to keep the cache files
+        :param ttl: seconds an entry is used without revalidation
+        :param max_size: size limit of the cache in bytes
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(e.stat().st_size for e in os.scandir(directory) if e.name.endswith('.json'))
+
+    def _path(self, url):
+        return pj(self.directory, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _load(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _store(self, path, entry):
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        atomic_write_json(path, entry, ensure_ascii=False)
+        with self._lock:
+            self._size += os.stat(path).st_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits max_size
+
+        Must be called with the lock held.
+        """
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith('.json')]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries:
+            if self._size <= self.max_size:
+                break
+            size = e.stat().st_size
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def get(self, url):
+        """Return the body of the response for url as a string
+
+        Non-cacheable errors are raised as urllib.error.HTTPError, like urlopen() does.
+        """
+        path = self._path(url)
+        entry = self._load(path)
+
+        if entry and time.time() - entry['fetched'] < self.ttl:
+            # Fresh - mark as recently used
+            os.utime(path)
+            _lookups.inc(result='hit')
+            return entry['body']
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with urlopen(url, headers=headers) as response:
+                body = response.read().decode()
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not entry:
+                raise
+            # Not modified - the cached body is good for another ttl
+            _lookups.inc(result='revalidated')
+            entry['fetched'] = time.time()
+            self._store(path, entry)
+            return entry['body']
+
+        _lookups.inc(result='miss')
+        self._store(path, {'url': url,
+                           'fetched': time.time(),
+                           'etag': headers.get('ETag'),
+                           'last_modified': headers.get('Last-Modified'),
+                           'body': body})
+        return body
@@ -0,0 +1,121 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from jwlib.metrics import metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+_seconds = metrics.histogram('jw_checksum_seconds', 'time spent hashing a file')
+_bytes = metrics.counter('jw_checksum_bytes_total', 'bytes read for hashing')
+_remembered = metrics.counter('jw_checksum_remembered_total', 'files whose remembered sum could be used')
+
+
+def md5(file):
+    """Return MD5 of a file."""
+    hash_md5 = hashlib.md5()
+    # Read big chunks into the same buffer, hashlib releases the GIL while hashing them
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with _seconds.time(), open(file, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            hash_md5.update(view[:n])
+            _bytes.inc(n)
+    return hash_md5.hexdigest()
+
+
+def md5_files(files, jobs=None):
+    """Return MD5 of many files, hashing them in parallel
+
+    :param files: list of paths
+    :param jobs: number of threads, default is the number of CPUs
+    :return: dict with paths as keys and MD5s as values
+    """
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        return dict(zip(files, pool.map(md5, files)))
+
+
+class ChecksumStore:
+    """MD5 sums of files, remembered between runs
+
+    A sum is only trusted as long as the size, modification time and inode
+    of the file are the same as when it was calculated.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                             'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)')
+
+    @staticmethod
+    def _key(file):
+        st = os.stat(file)
+        return os.path.abspath(file), st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, file):
+        """Return the remembered MD5 of file, or None if unknown or outdated"""
+        path, size, mtime_ns, inode = self._key(file)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, inode, md5 FROM files WHERE path = ?',
+                                   (path,)).fetchone()
+        if row and row[:3] == (size, mtime_ns, inode):
+            _remembered.inc()
+            return row[3]
+        return None
+
+    def put(self, file, digest):
+        """Remember the MD5 of file as it is right now"""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', self._key(file) + (digest,))
+
+    def forget(self, file):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(file),))
+
+    def md5_many(self, files, rehash=False, jobs=None):
+        """Return MD5 of many files, hashing the ones without a remembered sum in parallel
+
+        :param rehash: ignore remembered sums
+        :param jobs: number of threads
+        :return: dict with paths as keys and MD5s as values, and the number of bytes hashed
+        """
+        result = {}
+        todo = []
+        for file in files:
+            digest = None if rehash else self.get(file)
+            if digest is None:
+                todo.append(file)
+            else:
+                result[file] = digest
+
+        hashed = md5_files(todo, jobs)
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                 [self._key(file) + (digest,) for file, digest in hashed.items()])
+        result.update(hashed)
+        return result, sum(os.path.getsize(file) for file in todo)
+
+    def md5(self, file, rehash=False):
+        """Return MD5 of file, only reading it if the remembered sum is outdated
+
+        :param rehash: ignore the remembered sum
+        """
+        digest = None if rehash else self.get(file)
+        if digest is None:
+            digest = md5(file)
+            self.put(file, digest)
+        return digest
+
+    def close(self):
+        with self._lock:
+            self._db.close()
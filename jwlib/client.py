@@ -0,0 +1,283 @@
+import io
+import time
+import base64
+import zlib
+import threading
+import http.client
+import urllib.parse
+import urllib.error
+import urllib.request
+from sys import stderr
+
+from jwlib.metrics import metrics
+
+# Statuses worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_requests = metrics.counter('jw_http_requests_total', 'HTTP requests, by status')
+_request_seconds = metrics.histogram('jw_http_request_seconds', 'time until the response headers arrived')
+_retries = metrics.counter('jw_http_retries_total', 'HTTP requests tried again')
+_received_bytes = metrics.counter('jw_http_received_bytes_total', 'bytes of response bodies, after decompression')
+
+
+def msg(s):
+    print(s, file=stderr, flush=True)
+
+
+class Response:
+    """A response from :class:`HTTPClient`, used like the one from urlopen()
+
+    The body is decompressed transparently. The connection goes back to the
+    pool when the response is closed after being read to the end.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+        encoding = self.headers.get('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = None
+        self._first_chunk = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getcode(self):
+        return self.status
+
+    def _decompress(self, data):
+        if self._first_chunk and self._decompressor and self.headers.get('Content-Encoding', '').lower() == 'deflate':
+            # Some servers send raw deflate without zlib header
+            self._first_chunk = False
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def read(self, amt=None):
+        """Read (decompressed) data, all of it if amt is None"""
+        data = self._read(amt)
+        _received_bytes.inc(len(data))
+        return data
+
+    def _read(self, amt=None):
+        if not self._decompressor:
+            return self._response.read(amt)
+        if amt is None:
+            return self._decompress(self._response.read()) + self._decompressor.flush()
+        while True:
+            raw = self._response.read(amt)
+            if not raw:
+                return self._decompressor.flush()
+            data = self._decompress(raw)
+            # A chunk may be all header, don't signal EOF by mistake
+            if data:
+                return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, self._conn)
+        else:
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+
+
+class Proxy:
+    """A proxy server taken from the environment, like urlopen() does"""
+
+    def __init__(self, url):
+        if '://' not in url:
+            url = 'http://' + url
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.headers = {}
+        if parts.username:
+            credentials = urllib.parse.unquote(parts.username) + ':' + urllib.parse.unquote(parts.password or '')
+            self.headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+
+    @classmethod
+    def find(cls, scheme, host):
+        """Return the Proxy for a URL from http_proxy, https_proxy and no_proxy, or None"""
+        url = urllib.request.getproxies().get(scheme)
+        if not url or urllib.request.proxy_bypass(host):
+            return None
+        return cls(url)
+
+
+class ConnectionPool:
+    """Idle keep-alive connections, per scheme, host and port"""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, timeout, proxy=None):
+        """Return an idle connection and True, or a new connection and False
+
+        :param proxy: Proxy to connect through, HTTPS goes through a tunnel
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if proxy and scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy.host, proxy.port, timeout=timeout)
+            conn.set_tunnel(host, port, headers=proxy.headers)
+        elif proxy:
+            conn = http.client.HTTPConnection(proxy.host, proxy.port, timeout=timeout)
+        elif scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+class HTTPClient:
+    """HTTP client that reuses connections
+
+    Requests ask for gzip/deflate compression, time out after :var:`timeout`
+    seconds and are retried :var:`retries` times with exponential backoff
+    on connection errors and server errors. Proxies are taken from the
+    environment, like urlopen() does.
+    """
+    timeout = 30
+    retries = 3
+    backoff = 1
+    user_agent = 'jw-scripts'
+
+    def __init__(self, maxsize=8):
+        """
+        :param maxsize: max number of idle connections kept per host
+        """
+        self.pool = ConnectionPool(maxsize)
+        # Proxy (or None) for every scheme, host and port, see Proxy.find()
+        self._proxies = {}
+
+    def open(self, url, headers=None, compress=True, method='GET'):
+        """Send a request and return a :class:`Response`
+
+        Redirects are followed. Other statuses from 300 and up raise
+        urllib.error.HTTPError, just like urlopen() does.
+
+        :param url: URL to request
+        :param headers: dict of extra request headers
+        :param compress: ask for a compressed response
+        :param method: HTTP method
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', self.user_agent)
+        if compress:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        else:
+            headers.setdefault('Accept-Encoding', 'identity')
+
+        for _ in range(10):
+            response = self._request(method, url, headers)
+            if response.status in REDIRECT_STATUSES and response.headers.get('Location'):
+                response.read()
+                response.close()
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                continue
+            if response.status >= 300:
+                body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, io.BytesIO(body))
+            return response
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    def _request(self, method, url, headers):
+        """Send a single request, retrying on failures"""
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if key not in self._proxies:
+            self._proxies[key] = Proxy.find(scheme, parts.hostname)
+        proxy = self._proxies[key]
+        if proxy and scheme == 'http':
+            # A plain HTTP proxy gets the whole URL
+            path = urllib.parse.urlunsplit((scheme, parts.netloc, path, '', ''))
+            headers = dict(headers, **proxy.headers)
+
+        attempt = 0
+        while True:
+            conn, reused = self.pool.get(key, self.timeout, proxy)
+            start = time.monotonic()
+            try:
+                conn.request(method, path, headers=headers)
+                r = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                _requests.inc(status='error')
+                if reused:
+                    # The server probably closed the idle connection, try a fresh one
+                    continue
+                if attempt >= self.retries:
+                    raise urllib.error.URLError(e)
+                error = e
+            else:
+                _request_seconds.observe(time.monotonic() - start)
+                _requests.inc(status=r.status)
+                response = Response(self.pool, key, conn, r, url)
+                if r.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                response.read()
+                response.close()
+                error = '{} {}'.format(r.status, r.reason)
+
+            attempt += 1
+            _retries.inc()
+            delay = self.backoff * 2 ** (attempt - 1)
+            msg('{}: {}, retrying in {} s'.format(parts.hostname, error, delay))
+            time.sleep(delay)
+
+
+# Shared by everyone, so connections get reused across the whole run
+client = HTTPClient()
+
+
+def urlopen(url, headers=None, compress=True):
+    """Shortcut for :method:`HTTPClient.open` on the shared client"""
+    return client.open(url, headers=headers, compress=compress)
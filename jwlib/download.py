@@ -0,0 +1,386 @@
+import os
+import re
+import json
+import hashlib
+import time
+import shutil
+import threading
+from sys import stderr
+from concurrent.futures import ThreadPoolExecutor
+
+from jwlib.atomic import atomic_write_json
+from jwlib.client import urlopen
+from jwlib.metrics import metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+_resume_refused = metrics.counter('jw_download_resume_refused_total', 'resumes where the server sent the whole file')
+_segment_fallbacks = metrics.counter('jw_download_segment_fallbacks_total',
+                                     'segmented downloads done in one piece, since the server ignored ranges')
+
+
+def parse_rate(rate):
+    """Convert a curl style rate like 500k or 1M to bytes per second
+
+    0 means no limit.
+    """
+    match = re.fullmatch(r'([0-9.]+)\s*([kKmMgG]?)', str(rate).strip())
+    if not match:
+        raise ValueError('wrong rate format: {}'.format(rate))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmg'.index(unit.lower() or ' '))
+
+
+class TokenBucket:
+    """Rate limit shared by several threads
+
+    Every thread takes tokens (bytes) out of the same bucket, which refills at
+    :var:`rate` bytes per second, so the total never exceeds the rate.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: bytes per second
+        """
+        self.rate = rate
+        self._tokens = float(rate)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """Take n bytes worth of tokens, sleeping if the bucket runs dry"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Go into debt, the sleep pays it back
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Progress:
+    """Status line with per-file and total download progress
+
+    Files are watched by polling their size, so it works the same way for
+    curl and the built-in downloader.
+    """
+    interval = 1
+
+    def __init__(self, total, quiet=0):
+        """
+        :param total: number of files to download, or None if not known yet
+        :param quiet: log level, no status line if >= 1
+        """
+        self.total = total
+        self.done = 0
+        self.quiet = quiet
+        self._files = {}
+        # Progress reported by the downloader, instead of the file size
+        self._current = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # The status line is on screen
+        self._drawn = False
+        # A message is waiting for the rest of its line
+        self._partial = False
+
+    def start(self):
+        if self.quiet < 1 and stderr.isatty():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            with self._lock:
+                if self._drawn:
+                    print('\r\033[K', end='', file=stderr, flush=True)
+                    self._drawn = False
+
+    def message(self, s, end='\n', file=stderr):
+        """Print a message in place of the status line, which is drawn again below it"""
+        with self._lock:
+            if self._drawn:
+                print('\r\033[K', end='', file=stderr, flush=True)
+                self._drawn = False
+            print(s, end=end, file=file, flush=True)
+            self._partial = not end.endswith('\n')
+
+    def add(self, file, size, name):
+        """Start watching a file that is expected to grow to size bytes"""
+        with self._lock:
+            self._files[file] = (size, name)
+
+    def set(self, file, current):
+        """Report how many bytes of file are done, for files that don't grow from the start"""
+        with self._lock:
+            self._current[file] = current
+
+    def remove(self, file):
+        """Stop watching a file and count it as finished"""
+        with self._lock:
+            self._files.pop(file, None)
+            self._current.pop(file, None)
+            self.done += 1
+
+    def _run(self):
+        last_total = 0
+        last_time = time.monotonic()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                files = dict(self._files)
+                reported = dict(self._current)
+                done = self.done
+            parts = []
+            total = 0
+            for file, (size, name) in files.items():
+                try:
+                    current = reported.get(file) or os.stat(file).st_size
+                except FileNotFoundError:
+                    current = 0
+                total += current
+                if size:
+                    parts.append('{} {}%'.format(name, current * 100 // size))
+                else:
+                    parts.append('{} {} MiB'.format(name, current // 1024**2))
+
+            now = time.monotonic()
+            # Files come and go, so only count growth
+            speed = max(total - last_total, 0) / (now - last_time)
+            last_total, last_time = total, now
+
+            line = ' | '.join(['[{}/{}] {:.1f} MiB/s'.format(done, self.total or '?', speed / 1024**2)] + parts)
+            width = shutil.get_terminal_size().columns - 1
+            with self._lock:
+                if self._partial:
+                    # Don't write over the start of a message
+                    continue
+                print('\r\033[K' + line[:width], end='', file=stderr, flush=True)
+                self._drawn = True
+
+
+class DownloadScheduler:
+    """Run downloads on several threads, sharing one rate limit"""
+
+    def __init__(self, workers=1, rate_limit='0', quiet=0):
+        """
+        :param workers: number of files to download at the same time
+        :param rate_limit: total rate limit, curl style (0 = no limit)
+        :param quiet: log level
+        """
+        self.workers = max(workers, 1)
+        self.rate = parse_rate(rate_limit)
+        self.bucket = TokenBucket(self.rate) if self.rate else None
+        self.quiet = quiet
+        self.progress = None
+
+    def run(self, items, func):
+        """Call func(index, item) for all items
+
+        items may be any iterable, like a generator that is still producing
+        items. Items are only taken from it when a worker is free.
+
+        If a call raises an exception, no more items are started. Running
+        ones are allowed to finish and then the exception is raised again.
+
+        :return: list of return values, in the same order as items
+        """
+        known_total = len(items) if hasattr(items, '__len__') else None
+        self.progress = Progress(known_total, self.quiet)
+        stopped = threading.Event()
+        # Don't take items from the iterable faster than they are handled
+        free = threading.Semaphore(self.workers)
+
+        def job(i, item):
+            try:
+                if stopped.is_set():
+                    return None
+                return func(i, item)
+            except BaseException:
+                stopped.set()
+                raise
+            finally:
+                free.release()
+
+        self.progress.start()
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for i, item in enumerate(items):
+                    free.acquire()
+                    if stopped.is_set():
+                        break
+                    if known_total is None:
+                        self.progress.total = i + 1
+                    futures.append(pool.submit(job, i, item))
+            return [f.result() for f in futures]
+        finally:
+            stopped.set()
+            self.progress.stop()
+
+
+def fetch(url, file, resume=False, bucket=None):
+    """Download url to file with the built-in HTTP client
+
+    The MD5 sum is calculated while the data arrives, so the file doesn't
+    have to be read again to check it.
+
+    :param url: URL to download
+    :param file: file to save to
+    :param resume: append what is missing to the end of file
+    :param bucket: a TokenBucket to throttle the download, or None
+    :return: MD5 of the whole file (hex)
+    """
+    headers = {}
+    md5 = hashlib.md5()
+
+    if resume:
+        # Ask server to skip the first N bytes
+        headers['Range'] = 'bytes={}-'.format(os.stat(file).st_size)
+
+    with urlopen(url, headers=headers, compress=False) as response:
+        if resume and response.status == 206:
+            # Append data to file, and start the sum with what is already there
+            file_mode = 'ab'
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    md5.update(chunk)
+        else:
+            # Not resuming, or the server ignored the range
+            if resume:
+                _resume_refused.inc()
+            file_mode = 'wb'
+
+        with open(file, file_mode) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                md5.update(chunk)
+                if bucket:
+                    bucket.consume(len(chunk))
+
+    return md5.hexdigest()
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def _load_segments(file):
+    """Return the segment list of an unfinished segmented download of file, or None"""
+    try:
+        with open(file + '.segments', 'r', encoding='utf-8') as f:
+            return json.load(f)['segments']
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def _save_segments(file, segments):
+    atomic_write_json(file + '.segments', {'segments': segments})
+
+
+def part_size(file):
+    """Return the number of bytes downloaded to file
+
+    For an unfinished segmented download, the file already has its full size,
+    so the bytes are counted from the segment list instead.
+    """
+    segments = _load_segments(file)
+    if segments is None:
+        return os.path.getsize(file)
+    return sum(written for start, end, written in segments)
+
+
+def remove_part(file):
+    """Delete a partly downloaded file, and its segment list if any"""
+    for f in (file, file + '.segments'):
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+
+def fetch_segmented(url, file, size, segments=4, bucket=None, progress=None):
+    """Download url to file over several connections at once
+
+    The file is split into byte ranges that are written in place into a
+    preallocated file. How far each range has come is saved in
+    file + '.segments', so an interrupted download only fetches what is
+    missing. The list is removed when all ranges are done.
+
+    If the server doesn't support ranges, it falls back to :func:`fetch`.
+
+    :param url: URL to download
+    :param file: file to save to
+    :param size: size of the file in bytes
+    :param segments: number of ranges (and connections)
+    :param bucket: a TokenBucket to throttle the download, or None
+    :param progress: function called with the number of bytes done
+    :return: None, since the MD5 can't be calculated out of order
+             (or the MD5 from fetch() if it fell back to that)
+    """
+    state = _load_segments(file)
+    if state is None or not os.path.exists(file):
+        with open(file, 'wb') as f:
+            f.truncate(size)
+        step = -(-size // segments)
+        state = [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+        _save_segments(file, state)
+
+    lock = threading.Lock()
+    last_save = [time.monotonic()]
+
+    def save(force=False):
+        # Called with the lock held
+        if force or time.monotonic() - last_save[0] > 1:
+            _save_segments(file, state)
+            last_save[0] = time.monotonic()
+
+    def worker(segment):
+        start, end, written = segment
+        if start + written > end:
+            return
+        headers = {'Range': 'bytes={}-{}'.format(start + written, end)}
+        with urlopen(url, headers=headers, compress=False) as response:
+            if response.status != 206:
+                raise RangeNotSupported
+            # Unbuffered, so the saved progress never gets ahead of the data
+            with open(file, 'r+b', buffering=0) as f:
+                f.seek(start + written)
+                while start + segment[2] <= end:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunk = chunk[:end + 1 - start - segment[2]]
+                    f.write(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        save()
+                        if progress:
+                            progress(sum(s[2] for s in state))
+                    if bucket:
+                        bucket.consume(len(chunk))
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(state)) as pool:
+            futures = [pool.submit(worker, segment) for segment in state]
+        for future in futures:
+            future.result()
+    except RangeNotSupported:
+        _segment_fallbacks.inc()
+        remove_part(file)
+        return fetch(url, file, bucket=bucket)
+    finally:
+        if os.path.exists(file + '.segments'):
+            with lock:
+                save(force=True)
+
+    if sum(s[2] for s in state) == size:
+        os.remove(file + '.segments')
+    return None
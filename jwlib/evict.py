@@ -0,0 +1,127 @@
+import os
+import time
+import heapq
+import shutil
+import threading
+from sys import stderr
+
+from jwlib.metrics import metrics
+
+# Only these get deleted to make room
+MEDIA_EXTENSIONS = ('.mp4', '.m4v', '.mp3')
+
+_evicted_files = metrics.counter('jw_evicted_files_total', 'files deleted to keep disk space free')
+_evicted_bytes = metrics.counter('jw_evicted_bytes_total', 'bytes deleted to keep disk space free')
+
+
+def msg(s):
+    print(s, file=stderr, flush=True)
+
+
+class Evictor:
+    """Delete the oldest media files in a directory to keep disk space free
+
+    Files are ordered by modification time, which download_media() sets to
+    the date of publishing. A .deleted file is left in place of every deleted
+    file, so prepare_download() won't download it again.
+
+    Free space is only asked from the OS every :var:`resync_interval` seconds,
+    or when it seems to be running out. In between, space handed out to
+    downloads is subtracted from the last known value.
+    """
+    resync_interval = 10
+
+    def __init__(self, directory, keep_free, quiet=0, log=msg):
+        """
+        :param directory: directory with media files
+        :param keep_free: bytes to keep free, 0 to never delete anything
+        :param quiet: log level
+        :param log: function that prints a message
+        """
+        self.directory = directory
+        self.keep_free = keep_free
+        self.quiet = quiet
+        self.log = log
+        self._lock = threading.Lock()
+        # Heap of (mtime, name, size), built when first needed
+        self._files = None
+        # Bytes reserved by downloads in progress
+        self._in_flight = {}
+        self._free = 0
+        self._synced = None
+
+    def _sync(self):
+        """Get free space from the OS, minus what downloads in progress may still write"""
+        self._free = shutil.disk_usage(self.directory).free - sum(self._in_flight.values())
+        self._synced = time.monotonic()
+
+    def _scan(self):
+        self._files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(MEDIA_EXTENSIONS):
+                    st = entry.stat()
+                    self._files.append((st.st_mtime, entry.name, st.st_size))
+        heapq.heapify(self._files)
+
+    def _evict_one(self, date=None):
+        """Delete the oldest file, if it is older than date
+
+        :return: True if a file was deleted
+        """
+        if self._files is None:
+            self._scan()
+        while self._files:
+            mtime, name, size = self._files[0]
+            if date and mtime >= date:
+                return False
+            heapq.heappop(self._files)
+            path = os.path.join(self.directory, name)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            # Leave a tombstone so it won't be downloaded again
+            with open(path + '.deleted', 'w'):
+                pass
+            self._free += size
+            _evicted_files.inc()
+            _evicted_bytes.inc(size)
+            if self.quiet < 2:
+                self.log('removing old file to free space: {}'.format(name))
+            return True
+        return False
+
+    def make_room(self, key, size, date=None):
+        """Reserve space for a download, deleting older files if needed
+
+        :param key: anything to identify the download in :method:`release`
+        :param size: bytes needed
+        :param date: only delete files older than this (seconds since epoch)
+        :return: True if there is enough space
+        """
+        with self._lock:
+            if self._synced is None or time.monotonic() - self._synced > self.resync_interval:
+                self._sync()
+            if self._free - size < self.keep_free:
+                # Check the real numbers before deleting anything
+                self._sync()
+            while self._free - size < self.keep_free:
+                # Without --free, nothing is ever deleted
+                if self.keep_free <= 0 or not self._evict_one(date):
+                    return False
+            self._free -= size
+            self._in_flight[key] = size
+            return True
+
+    def release(self, key):
+        """Mark a download as finished"""
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def add(self, file):
+        """Add a newly downloaded file to the files that may be deleted"""
+        with self._lock:
+            if self._files is not None and file.endswith(MEDIA_EXTENSIONS):
+                st = os.stat(file)
+                heapq.heappush(self._files, (st.st_mtime, os.path.basename(file), st.st_size))
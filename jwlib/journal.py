@@ -0,0 +1,107 @@
+import os
+import json
+import threading
+
+from jwlib.atomic import atomic_write
+
+PENDING = 'pending'
+PARTIAL = 'partial'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueJournal:
+    """The planned downloads and how far each of them got, kept on disk
+
+    The journal is a file with one JSON object per line. An "add" line puts
+    an item in the queue, and a "state" line changes the state of the item
+    with that index. Lines are only ever appended and synced, so a crash
+    loses at most the line being written, which :method:`load` skips.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: journal file
+        """
+        self.path = path
+        self._file = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        # Called with the lock held
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def start(self, items=()):
+        """Start a new journal, replacing the old one
+
+        :param items: dicts describing the queued downloads
+        """
+        items = list(items)
+        atomic_write(self.path, ''.join(json.dumps({'add': item}, separators=(',', ':')) + '\n' for item in items),
+                     fsync=True)
+        with self._lock:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._count = len(items)
+
+    def add(self, item):
+        """Add an item to the end of the queue
+
+        :return: index of the item
+        """
+        with self._lock:
+            self._write({'add': item})
+            self._count += 1
+            return self._count - 1
+
+    def set(self, index, state, offset=None):
+        """Record the state of an item
+
+        :param state: PENDING, PARTIAL, DONE or FAILED
+        :param offset: bytes downloaded so far, for PARTIAL
+        """
+        record = {'i': index, 'state': state}
+        if offset is not None:
+            record['offset'] = offset
+        with self._lock:
+            if self._file:
+                self._write(record)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """Close and delete the journal"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def load(self):
+        """Read the journal
+
+        :return: list of [item, state, offset] in queue order, or None if there is no journal
+        """
+        try:
+            f = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        entries = []
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off by a crash
+                    continue
+                if 'add' in record:
+                    entries.append([record['add'], PENDING, 0])
+                elif 0 <= record.get('i', -1) < len(entries):
+                    entries[record['i']][1:] = [record['state'], record.get('offset', 0)]
+        return entries
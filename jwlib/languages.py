@@ -0,0 +1,113 @@
+import os
+import json
+import time
+from sys import stderr
+
+from jwlib.atomic import atomic_write_json
+from jwlib.cache import default_cache_dir
+from jwlib.client import urlopen
+
+pj = os.path.join
+
+LANGUAGES_URL = 'https://data.jw-api.org/mediator/v1/languages/E/web?clientType=tvjworg'
+# Seconds before the local copy is considered stale
+REFRESH_INTERVAL = 7 * 24 * 3600
+
+
+def msg(s):
+    print(s, file=stderr, flush=True)
+
+
+class LanguageCatalog:
+    """Language codes and names, kept in a local file
+
+    The list is downloaded only when the local copy is missing or older than
+    :var:`refresh_interval`, or when someone asks for a code that isn't in it.
+    The local copy follows the response cache settings, see :method:`use_cache`.
+    """
+    url = LANGUAGES_URL
+
+    def __init__(self, path=None, refresh_interval=REFRESH_INTERVAL):
+        """
+        :param path: JSON file to keep the catalog in, see also :method:`use_cache`
+        :param refresh_interval: seconds before the catalog is downloaded again
+        """
+        self.path = path or pj(default_cache_dir(), 'languages.json')
+        self.refresh_interval = refresh_interval
+        self._languages = None
+        self._fetched = 0
+        # Only refresh once per run for unknown codes
+        self._refreshed = False
+
+    def use_cache(self, directory=None, enabled=True):
+        """Keep the catalog in directory, like the response cache
+
+        :param directory: cache directory, default_cache_dir() if None
+        :param enabled: if False, the catalog is neither read from nor saved to disk
+        """
+        path = pj(directory or default_cache_dir(), 'languages.json') if enabled else None
+        if path != self.path:
+            self.path = path
+            if not self._refreshed:
+                # Read again from the new place
+                self._languages = None
+                self._fetched = 0
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._languages = data['languages']
+            self._fetched = data['fetched']
+        except (FileNotFoundError, ValueError, KeyError):
+            self._languages = None
+
+    def refresh(self):
+        """Download the language list and save it"""
+        with urlopen(self.url) as response:
+            response = json.loads(response.read().decode())
+        self._languages = {lang['code']: lang['name'] for lang in response['languages']}
+        self._fetched = time.time()
+        self._refreshed = True
+
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write_json(self.path, {'fetched': self._fetched, 'languages': self._languages},
+                          ensure_ascii=False, indent=4)
+
+    @property
+    def languages(self):
+        """Dict with language codes as keys and names as values"""
+        if self._languages is None:
+            self._load()
+        if self._languages is None or time.time() - self._fetched > self.refresh_interval:
+            try:
+                self.refresh()
+            except OSError:
+                # Offline - a stale list is better than none
+                if self._languages is None:
+                    raise
+        return self._languages
+
+    def is_valid(self, code):
+        """Check a language code, refreshing the catalog if the code is unknown"""
+        if code in self.languages:
+            return True
+        if not self._refreshed:
+            try:
+                self.refresh()
+            except OSError:
+                pass
+        return code in self._languages
+
+    def print_codes(self):
+        """Print a table of language codes to stderr"""
+        msg('language codes:')
+        for code, name in sorted(self.languages.items(), key=lambda x: x[1]):
+            msg('{:>3}  {:<}'.format(code, name))
+
+
+catalog = LanguageCatalog()
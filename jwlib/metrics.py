@@ -0,0 +1,183 @@
+import json
+import time
+import atexit
+import bisect
+import threading
+
+from jwlib.atomic import atomic_write
+
+# Upper bounds in seconds, good for both API requests and whole downloads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+def _labels(labels):
+    """Turn keyword labels into a hashable key"""
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in key) + '}'
+
+
+class Counter:
+    """A number that only goes up, optionally split by labels"""
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def samples(self):
+        """Return a list of (suffix, label pairs, value)"""
+        with self._lock:
+            # Report 0 before anything happened, so the series exists from the start
+            return [('', key, value) for key, value in sorted(self._values.items())] or [('', (), 0)]
+
+    def to_dict(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A number that is set to the latest value"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def time(self, **labels):
+        """Context manager that sets the gauge to the time spent in it"""
+        return _Timer(lambda seconds: self.set(seconds, **labels))
+
+
+class Histogram:
+    """Distribution of observed values, like durations"""
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """Context manager that observes the time spent in it"""
+        return _Timer(self.observe)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append(('_bucket', (('le', le),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+    def to_dict(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        return {'buckets': dict(zip([repr(b) for b in self.buckets] + ['+Inf'], counts)),
+                'sum': total,
+                'count': sum(counts)}
+
+
+class _Timer:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.callback(time.monotonic() - self.start)
+
+
+class Registry:
+    """All metrics of a run, written out as a Prometheus textfile or JSON
+
+    Metrics are created on first use, so modules can ask for the same
+    metric by name without coordinating.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def to_prometheus(self):
+        """Return all metrics in the Prometheus text format"""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            for suffix, key, value in metric.samples():
+                lines.append('{}{}{} {}'.format(name, suffix, _format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        return json.dumps({name: dict(type=metric.type, help=metric.help, data=metric.to_dict())
+                           for name, metric in sorted(self._metrics.items())}, indent=2)
+
+    def write_at_exit(self, path):
+        """Write all metrics to path when the program exits, also after an error"""
+        start = time.monotonic()
+
+        def write():
+            self.gauge('jw_run_seconds', 'duration of the run').set(time.monotonic() - start)
+            self.gauge('jw_run_finished_timestamp_seconds', 'when the run ended').set(time.time())
+            self.write(path)
+
+        atexit.register(write)
+
+    def write(self, path):
+        """Write all metrics to path, as JSON if it ends with .json, else in Prometheus format
+
+        The file is replaced in one go, so a collector never reads half of it.
+        """
+        atomic_write(path, self.to_json() if path.endswith('.json') else self.to_prometheus())
+
+
+# Shared by everyone, written by the scripts at exit
+metrics = Registry()
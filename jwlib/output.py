@@ -1,26 +1,16 @@
 import os
 from sys import stderr
 import re
+import json
+import hashlib
+
+from jwlib.atomic import atomic_write, atomic_write_json
 
 pj = os.path.join
 
 SAFE_FILE_NAMES = False
-
-
-def _truncate_file(file, string=''):
-    """Create a file and the parent directories."""
-    d = os.path.dirname(file)
-    os.makedirs(d, exist_ok=True)
-
-    # Don't truncate non-empty files
-    try:
-        if os.stat(file).st_size != 0:
-            return
-    except FileNotFoundError:
-        pass
-
-    with open(file, 'w', encoding='utf-8') as f:
-        f.write(string)
+_NTFS_FORBIDDEN = re.compile('[<>:"|?*/\\\\\0]')
+_UNIX_FORBIDDEN = re.compile('[/\\\\\0]')
 
 
 def output_stdout(categories, wd, uniq=False):
@@ -46,23 +36,53 @@ def output_stdout(categories, wd, uniq=False):
         print(f'[{i}/{len(sort)}] {file_name[1]}\t{file_name[0]}')
 
 
-def _write_to_m3u(source, name, file):
-    """Write entry to a M3U playlist file."""
-    _truncate_file(file, string='#EXTM3U\n')
-    with open(file, 'a', encoding='utf-8') as f:
-        f.write('#EXTINF:0,' + name + '\n' + source + '\n')
+M3U_HEADER = '#EXTM3U\n'
+HTML_HEADER = '<!DOCTYPE html>\n<head><meta charset="utf-8" /></head>'
+
+
+def _m3u_entry(source, name):
+    """Return a M3U playlist entry."""
+    return '#EXTINF:0,' + name + '\n' + source + '\n'
+
+
+def _html_entry(source, name):
+    """Return a HTML hyperlink to a media file."""
+    return '\n<a href="{0}">{1}</a><br>'.format(source, name)
+
 
+def _write_file(file, content):
+    """Replace the content of a file in one go, unless it is the same already.
 
-def output_m3u(categories, wd, subdir, writer=_write_to_m3u, flat=False, file_ending='.m3u'):
+    :return: True if the file was written
+    """
+    data = content.encode('utf-8')
+    try:
+        if os.stat(file).st_size == len(data):
+            with open(file, 'rb') as f:
+                if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                    return False
+    except FileNotFoundError:
+        pass
+
+    atomic_write(file, data)
+    return True
+
+
+def output_m3u(categories, wd, subdir, writer=_m3u_entry, flat=False, file_ending='.m3u', header=M3U_HEADER):
     """Create a M3U playlist tree.
 
+    Every playlist is put together in memory and written with a single write.
+    Playlists that didn't change are left alone.
+
     :param categories: A list generated by JWBroadcasting.parse()
     :param wd: Path to destination directory
     :param subdir: Name for the subdir where data will be saved
-    :param writer: Function to write to files
+    :param writer: Function that returns the playlist entry for a source and a name
     :param flat: If all playlist will be saved outside of subdir
     :param file_ending: Well, duh
+    :param header: Text at the start of every playlist
     """
+    playlists = {}
     for category in categories:
 
         if flat:
@@ -82,11 +102,8 @@ def output_m3u(categories, wd, subdir, writer=_write_to_m3u, flat=False, file_en
             source_prepend_dir = ''
             output_file = pj(wd, subdir, category.key + file_ending)
 
-        # Since we want to start on a clean file, remove the old one
-        try:
-            os.remove(output_file)
-        except FileNotFoundError:
-            pass
+        # Start on a clean playlist, like an old one with the same name was never there
+        entries = playlists[output_file] = []
 
         for item in category.content:
             if item.iscategory:
@@ -100,69 +117,151 @@ def output_m3u(categories, wd, subdir, writer=_write_to_m3u, flat=False, file_en
                     source = pj('.', source_prepend_dir, os.path.basename(item.file))
                 else:
                     source = item.url
-            writer(source, name, output_file)
+            entries.append(writer(source, name))
 
-
-def _write_to_html(source, name, file):
-    """Write a HTML file with a hyperlink to a media file."""
-    _truncate_file(file, string='<!DOCTYPE html>\n<head><meta charset="utf-8" /></head>')
-    with open(file, 'a', encoding='utf-8') as f:
-        f.write('\n<a href="{0}">{1}</a><br>'.format(source, name))
+    directories = set()
+    for output_file, entries in playlists.items():
+        if not entries:
+            # Empty categories get no playlist
+            try:
+                os.remove(output_file)
+            except FileNotFoundError:
+                pass
+            continue
+        d = os.path.dirname(output_file)
+        if d not in directories:
+            os.makedirs(d, exist_ok=True)
+            directories.add(d)
+        _write_file(output_file, header + ''.join(entries))
 
 
 def output_html(categories, wd, subdir):
-    """Invokes output_m3u() with writer=_write_to_html and file_ending='.html')"""
-    output_m3u(categories, wd, subdir, writer=_write_to_html, file_ending='.html')
+    """Invokes output_m3u() with writer=_html_entry and file_ending='.html')"""
+    output_m3u(categories, wd, subdir, writer=_html_entry, file_ending='.html', header=HTML_HEADER)
+
+
+# Kept in the subdir by output_filesystem()
+MANIFEST = '.links.json'
+
+
+def _scan(directory):
+    """Return a dict with the names in directory as keys and os.DirEntry as values"""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        return {}
+
+
+def _load_manifest(file):
+    """Return the directories and links made by the last output_filesystem() run"""
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return set(manifest['dirs']), manifest['links']
+    except (FileNotFoundError, ValueError, KeyError):
+        return set(), {}
 
 
 def output_filesystem(categories, wd, subdir, include_keyname=False):
     """Creates a directory structure with symlinks to videos
 
+    The tree made by the last run is remembered in a manifest, so only the
+    differences are applied: new links are created, links that should point
+    somewhere else are replaced, and links that are no longer in the tree are
+    removed. Every directory is listed once to see what is really there.
+    Links whose target didn't change since the last run are not read.
+
     :param categories: A list generated by JWBroadcasting.parse()
     :param wd: Path to destination directory
     :param subdir: Name of subdir where data will be saved
     :param include_keyname: If categories will have keyname prepended
     """
+    # Category directories, inside subdir
+    dirs = set()
+    # Directories relative to wd, with the link names in them and what they point to
+    links = {}
+    up = '..' + os.sep
     for category in categories:
 
-        # Create the directory
-        output_dir = pj(wd, subdir, category.key)
-        os.makedirs(output_dir, exist_ok=True)
+        dirs.add(category.key)
 
         # Index/starting/home categories: create link outside subdir
         if category.home:
-            link = pj(wd, _filter_filename(category.name))
             # Note: the source will be relative
-            source = pj(subdir, category.key)
-            try:
-                os.symlink(source, link)
-            except FileExistsError:
-                pass
+            links.setdefault('', {}).setdefault(_filter_filename(category.name), pj(subdir, category.key))
 
+        output_dir = links.setdefault(pj(subdir, category.key), {})
         for item in category.content:
 
             if item.iscategory:
-                d = pj(wd, subdir, item.key)
-                os.makedirs(d, exist_ok=True)
-                source = pj('..', item.key)
+                dirs.add(item.key)
+                source = up + item.key
 
                 if include_keyname:
-                    link = pj(output_dir, item.key + ' - ' + _filter_filename(item.name))
+                    name = item.key + ' - ' + _filter_filename(item.name)
                 else:
-                    link = pj(output_dir, _filter_filename(item.name))
+                    name = _filter_filename(item.name)
 
             else:
                 if not item.file:
                     continue
 
-                source = pj('..', os.path.basename(item.file))
-                ext = os.path.splitext(item.file)[1]
-                link = pj(output_dir, _filter_filename(item.name + ext))
+                base = os.path.basename(item.file)
+                source = up + base
+                name = _filter_filename(item.name + os.path.splitext(base)[1])
 
-            try:
-                os.symlink(source, link)
-            except FileExistsError:
-                pass
+            # The first one wins if two items get the same name
+            output_dir.setdefault(name, source)
+
+    base = pj(wd, subdir)
+    manifest_file = pj(base, MANIFEST)
+    old_dirs, old_links = _load_manifest(manifest_file)
+
+    os.makedirs(base, exist_ok=True)
+    existing = _scan(base)
+    for d in dirs:
+        if d not in existing:
+            os.makedirs(pj(base, d), exist_ok=True)
+
+    for d in links.keys() | old_links.keys():
+        new = links.get(d, {})
+        old = old_links.get(d, {})
+        entries = _scan(pj(wd, d))
+
+        if new == old and all(name in entries and entries[name].is_symlink() for name in new):
+            # Nothing changed since the last run
+            continue
+
+        # Remove links that are gone from the tree, if nobody changed them
+        for name, source in old.items():
+            entry = entries.get(name)
+            if name not in new and entry and entry.is_symlink() and os.readlink(entry.path) == source:
+                os.remove(entry.path)
+
+        for name, source in new.items():
+            entry = entries.get(name)
+            path = pj(wd, d, name)
+            if entry is None:
+                os.symlink(source, path)
+            elif not entry.is_symlink():
+                # Not made by us, leave it alone
+                continue
+            elif old.get(name) != source and os.readlink(path) != source:
+                # Replace it in one go, so the link never goes missing
+                tmp = pj(wd, d, '.' + name + '.tmp')
+                os.symlink(source, tmp)
+                os.replace(tmp, path)
+
+    # Remove directories of categories that are gone, if they are empty now
+    for d in old_dirs - dirs:
+        try:
+            os.rmdir(pj(base, d))
+        except OSError:
+            pass
+
+    if dirs != old_dirs or links != old_links:
+        atomic_write_json(manifest_file, {'dirs': sorted(dirs), 'links': links}, ensure_ascii=False)
 
 
 def _filter_filename(name):
@@ -170,12 +269,12 @@ def _filter_filename(name):
 
     if SAFE_FILE_NAMES:
         # NTFS/FAT forbidden characters
-        regex = '[<>:"|?*/\\\\\0]'
+        regex = _NTFS_FORBIDDEN
     else:
         # Unix forbidden characters
-        regex = '[/\\\\\0]'
+        regex = _UNIX_FORBIDDEN
 
-    return re.sub(regex, '', name)
+    return regex.sub('', name)
 
 
 def clean_symlinks(d, clean_all=False, quiet=0):
@@ -1,17 +1,32 @@
+import sys
 from sys import platform
 from sys import stderr
+from sys import stdout
 import os
 import time
 import re
 import subprocess
 import shutil
+import threading
+import queue as queue_module
+import http.client
 
 import json
 import hashlib
-import urllib.request
+import urllib.error
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 from signs.constants import woext, ext
+from jwlib.atomic import atomic_write_json
+from jwlib.cache import ResponseCache, default_cache_dir
+from jwlib.client import client, urlopen
+from jwlib.download import DownloadScheduler, fetch, fetch_segmented, parse_rate, part_size, remove_part
+from jwlib.checksum import ChecksumStore, md5 as _md5
+from jwlib.evict import Evictor
+from jwlib.journal import QueueJournal, PARTIAL, DONE, FAILED
+from jwlib.languages import catalog
+from jwlib.metrics import metrics
 
 
 if platform.startswith('win'):
@@ -20,6 +35,16 @@ if platform.startswith('win'):
     kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), 7)
 
 
+_api_seconds = metrics.histogram('jw_api_fetch_seconds', 'time to get an API response, from the cache or the server')
+_stage_seconds = metrics.gauge('jw_stage_seconds', 'time spent in each stage')
+_checked = metrics.counter('jw_checked_files_total', 'media checked before downloading, by result')
+_downloads = metrics.counter('jw_downloads_total', 'finished downloads, by result')
+_download_seconds = metrics.histogram('jw_download_seconds', 'time to download and check a file')
+_downloaded_bytes = metrics.counter('jw_downloaded_bytes_total', 'bytes written to media files')
+_resumes = metrics.counter('jw_download_resumes_total', 'unfinished downloads that were resumed')
+_deleted = metrics.counter('jw_broken_files_total', 'files deleted for a bad size or checksum')
+
+
 def msg(s):
     print(s, file=stderr, flush=True)
 
@@ -38,20 +63,62 @@ class JWBroadcasting:
     streaming = False
     quiet = 0
     checksums = False
+    # Ignore checksums remembered from earlier runs
+    rehash = False
+    # Number of files to hash at the same time
+    hash_jobs = os.cpu_count() or 1
     title = False
     index_category = 'VideoOnDemand'
     rate_limit = '1M'
-    curl_path = 'curl'
+    # Download with curl instead of the built-in downloader if set
+    curl_path = None
     keep_free = 0
+    # Number of files to download at the same time
+    streams = 1
+    # Connections per file, for files of at least segment_threshold bytes
+    segments = 1
+    pipeline = False
+    segment_threshold = 64 * 1024**2
     exclude_category = ''
+    jobs = 1
+    # HTTP settings, see jwlib.client
+    timeout = 30
+    retries = 3
+    # Response cache, None means default_cache_dir()
+    cache = True
+    cache_dir = None
+    # Seconds a cached response is used without asking the server, 0 = always revalidate
+    cache_ttl = 0
+    # Only index media changed since the last --delta run
+    delta = False
     # Used if streaming is True
     utc_offset = 0
+    # API location, can be pointed to a local server for testing
+    mediator_url = 'https://data.jw-api.org/mediator/v1'
 
     def __init__(self):
         # Will populated with Media objects by parse()
         self.result = []
         # Used by download_media()
         self._checked_files = set()
+        # Set up by parse()
+        self._cache = None
+        # Set up by manage_downloads()
+        self._scheduler = None
+        # ChecksumStore for each download dir
+        self._checksum_stores = {}
+        # Checksums calculated during this run
+        self._hashed = {}
+        # Directory listings made by prepare_download(), see _scan_dir()
+        self._dir_index = {}
+        self._lock = threading.Lock()
+        # Set by parse() in delta mode
+        self.snapshot = None
+        self.added = []
+        self.changed = []
+        self.removed = []
+        # Media that manage_downloads() couldn't download
+        self.failed = []
 
     @property
     def lang(self):
@@ -63,28 +130,16 @@ class JWBroadcasting:
 
     @lang.setter
     def lang(self, code):
-        url = 'https://data.jw-api.org/mediator/v1/languages/E/web?clientType=tvjworg'
-
-        with urllib.request.urlopen(url) as response:
-            response = json.loads(response.read().decode())
-
-            if not code:
-                # Print table of language codes
-                msg('language codes:')
-                for lang in sorted(response['languages'], key=lambda x: x['name']):
-                    msg('{:>3}  {:<}'.format(lang['code'], lang['name']))
-                exit()
-            else:
-                # Check if the code is valid
-                for lang in response['languages']:
-                    if lang['code'] == code:
-                        self.__lang = code
-                        return
-                msg('language codes:')
-                for lang in sorted(response['languages'], key=lambda x: x['name']):
-                    msg('{:>3}  {:<}'.format(lang['code'], lang['name']))
-                print(code + ': invalid language code')
-                exit()
+        if not code:
+            # Print table of language codes
+            catalog.print_codes()
+            exit()
+        elif catalog.is_valid(code):
+            self.__lang = code
+        else:
+            catalog.print_codes()
+            print(code + ': invalid language code')
+            exit()
 
     @property
     def mindate(self):
@@ -106,22 +161,57 @@ class JWBroadcasting:
 
         :return: A list containing Category and Media objects
         """
+        with _stage_seconds.time(stage='parse'):
+            for _ in self.iter_parse():
+                pass
+        return self.result
+
+    def iter_parse(self):
+        """Index JW Broadcasting categories recursively
+
+        Categories are added to :var:`result` like :method:`parse` does.
+
+        :return: generator of Media objects, as soon as their category is decoded
+        """
         if self.streaming:
             section = 'schedules'
         else:
             section = 'categories'
 
+        self._open_cache()
+        delta = self.delta and not self.streaming
+        if delta:
+            old = self._load_snapshot()
+            old_media = {k: v for c in old['categories'].values() for k, v in c['media'].items()}
+            categories = {}
+        url_template = self.mediator_url + '/{s}/{L}/{c}?detailed=1&clientType=tvjworg&utcOffset={o}'
+
         # Load the queue with the requested (keynames of) categories
         queue = self.index_category.split(',')
         exclude = self.exclude_category.split(',')
-        for key in queue:
+
+        # Categories are fetched in parallel, but the responses are handled
+        # in queue order so the result is the same as with a serial crawl.
+        # futures[i] holds the pending request for queue[i]
+        pool = ThreadPoolExecutor(max_workers=max(self.jobs, 1))
+        futures = []
+
+        def enqueue(key):
             if key in exclude:
-                continue
-            url = 'https://data.jw-api.org/mediator/v1/{s}/{L}/{c}?detailed=1&clientType=tvjworg&utcOffset={o}'
-            url = url.format(s=section, L=self.lang, c=key, o=self.utc_offset)
+                futures.append(None)
+            else:
+                url = url_template.format(s=section, L=self.lang, c=key, o=self.utc_offset)
+                futures.append(pool.submit(self._get_json, url))
+
+        for key in queue:
+            enqueue(key)
 
-            with urllib.request.urlopen(url) as response:
-                response = json.loads(response.read().decode())
+        try:
+            for i, key in enumerate(queue):
+                if futures[i] is None:
+                    continue
+                response = futures[i].result()
+                futures[i] = None
 
                 if 'status' in response and response['status'] == '404':
                     raise ValueError('No such category or language')
@@ -136,6 +226,16 @@ class JWBroadcasting:
                 if self.quiet < 1:
                     msg('{} ({})'.format(cat.key, cat.name))
 
+                unchanged = False
+                if delta:
+                    # Categories whose JSON didn't change since last time
+                    # don't need their media decoded again
+                    digest = json.dumps(response['category'], sort_keys=True).encode()
+                    digest = hashlib.sha1(digest).hexdigest()
+                    old_cat = old['categories'].get(cat.key)
+                    unchanged = old_cat is not None and old_cat['hash'] == digest
+                    categories[cat.key] = old_cat if unchanged else {'hash': digest, 'media': {}}
+
                 if self.streaming:
                     # Save starting position
                     if 'position' in response['category']:
@@ -152,8 +252,9 @@ class JWBroadcasting:
                             # Add subcategory to queue for parsing later
                             if s.key not in queue:
                                 queue.append(s.key)
+                                enqueue(s.key)
 
-                if 'media' in response['category']:
+                if 'media' in response['category'] and not unchanged:
                     for media in response['category']['media']:
                         # Skip videos marked as hidden
                         if 'tags' in response['category']['media']:
@@ -168,6 +269,7 @@ class JWBroadcasting:
 
                         m = Media()
                         m.name = media['title']
+                        m.key = media.get('naturalKey')
                         if self.subtitles:
                             subs = self._get_subs(media['files'])
                             if 'url' in subs:
@@ -183,6 +285,13 @@ class JWBroadcasting:
                             if 'filesize' in mediafile:
                                 m.size = mediafile['filesize']
 
+                        if delta:
+                            m.key = m.key or m.url
+                            entry = [media.get('firstPublished'), m.md5]
+                            categories[cat.key]['media'][m.key] = entry
+                            if old_media.get(m.key) == entry:
+                                continue
+
                         # Save time data (not needed when streaming)
                         if 'firstPublished' in media and not self.streaming:
                             # Remove last stuff from date, what is it anyways?
@@ -198,8 +307,102 @@ class JWBroadcasting:
                                     continue
 
                         cat.add(m)
+                        yield m
+        finally:
+            # Don't wait for requests nobody is going to read
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            pool.shutdown()
+
+        if delta:
+            self._compare_snapshot(old, categories)
+
+    def _snapshot_path(self):
+        return os.path.join(self.work_dir, '.jwb-snapshot-{}.json'.format(self.lang))
+
+    def _load_snapshot(self):
+        """Return the catalog snapshot saved by the last --delta run"""
+        try:
+            with open(self._snapshot_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'roots': None, 'categories': {}}
 
-        return self.result
+    def _compare_snapshot(self, old, categories):
+        """Sort media into added, changed and removed, and build the new snapshot
+
+        :param old: snapshot from the last run
+        :param categories: snapshot entries of the categories crawled this time
+        """
+        if old['roots'] == self.index_category:
+            # Same crawl as last time - categories not seen anymore are gone
+            merged = categories
+        else:
+            # Keep what this crawl didn't reach
+            merged = dict(old['categories'])
+            merged.update(categories)
+        self.snapshot = {'roots': self.index_category, 'categories': merged}
+
+        old_keys = {k for c in old['categories'].values() for k in c['media']}
+        new_keys = {k for c in merged.values() for k in c['media']}
+        seen = set()
+        for cat in self.result:
+            for m in cat.content:
+                if m.iscategory or m.key in seen:
+                    continue
+                seen.add(m.key)
+                if m.key in old_keys:
+                    self.changed.append(m)
+                else:
+                    self.added.append(m)
+        self.removed = sorted(old_keys - new_keys)
+
+        if self.quiet < 1:
+            msg('delta: {} added, {} changed, {} removed'.format(
+                len(self.added), len(self.changed), len(self.removed)))
+
+    def save_snapshot(self):
+        """Save the catalog snapshot made by a --delta run of parse()
+
+        Media in :var:`failed` are left out, so the next run offers them again.
+        """
+        if self.snapshot is None:
+            return
+        snapshot = self.snapshot
+        failed = {m.key for m in self.failed}
+        if failed:
+            categories = {}
+            for key, cat in snapshot['categories'].items():
+                media = {k: v for k, v in cat['media'].items() if k not in failed}
+                if len(media) != len(cat['media']):
+                    # Without a hash the category is decoded again, and the media found missing
+                    cat = {'hash': None, 'media': media}
+                categories[key] = cat
+            snapshot = dict(snapshot, categories=categories)
+        os.makedirs(self.work_dir, exist_ok=True)
+        atomic_write_json(self._snapshot_path(), snapshot, separators=(',', ':'))
+
+    def _setup_client(self):
+        """Apply --timeout and --retries to the shared HTTP client"""
+        client.timeout = self.timeout
+        client.retries = self.retries
+        # Keep enough idle connections around for all parallel jobs and streams
+        client.pool.maxsize = max(client.pool.maxsize, self.jobs, self.streams)
+
+    def _open_cache(self):
+        """Set up the HTTP client and the response cache used by :method:`_get_json`"""
+        self._setup_client()
+        catalog.use_cache(self.cache_dir, self.cache)
+        if self.cache and self._cache is None:
+            self._cache = ResponseCache(self.cache_dir or default_cache_dir(), ttl=self.cache_ttl)
+
+    def _get_json(self, url):
+        """Fetch an URL, through the response cache if enabled, and return the decoded JSON"""
+        with _api_seconds.time():
+            if self._cache:
+                return json.loads(self._cache.get(url))
+            return _get_json(url)
 
     def _get_subs(self, video_list: list):
         for video in video_list:
@@ -229,21 +432,115 @@ class JWBroadcasting:
         best_video = videos[0]
         return best_video
 
-    def download_media(self, media, directory, check_only=False):
-        """Download media file and check it.
+    def _checksum_store(self, directory):
+        """Return the ChecksumStore kept in directory"""
+        with self._lock:
+            if directory not in self._checksum_stores:
+                path = os.path.join(directory, '.jwb-checksums.db')
+                self._checksum_stores[directory] = ChecksumStore(path)
+            return self._checksum_stores[directory]
+
+    def _checksum(self, file):
+        """Return MD5 of file, reading it only if it changed since it was last checked"""
+        if file in self._hashed:
+            return self._hashed[file]
+        return self._checksum_store(os.path.dirname(file)).md5(file, rehash=self.rehash)
+
+    @staticmethod
+    def _scan_dir(directory):
+        """List the files in directory in one pass
+
+        :return: dict with file names without extension as keys, and dicts of
+                 file names and os.stat_result as values
+        """
+        index = {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        index.setdefault(woext(entry.name), {})[entry.name] = entry.stat()
+        except FileNotFoundError:
+            pass
+        return index
+
+    @staticmethod
+    def _stat(file, index=None):
+        """Return os.stat_result of file, or None if it doesn't exist
+
+        :param index: a directory index from _scan_dir() to look in, instead of the disk
+        """
+        if index is not None:
+            return index.get(woext(file), {}).get(os.path.basename(file))
+        try:
+            return os.stat(file)
+        except FileNotFoundError:
+            return None
 
-        Download file, check MD5 sum and size, delete file if it missmatches.
+    @staticmethod
+    def _remove(file, index=None):
+        """Delete file and drop it from the directory index"""
+        os.remove(file)
+        if index is not None:
+            index.get(woext(file), {}).pop(os.path.basename(file), None)
 
-        :param media: a Media instance
-        :param directory: dir to save the files to
-        :param check_only: bool, True means no downloading
-        :return: filename, or None if unsuccessful
+    def _hash_files(self, media_list, wd):
+        """Calculate MD5 of the existing files of media_list in parallel
+
+        The results are used by :method:`_checksum` for the rest of the run.
+
+        :return: dict with files as keys and Media as values, and the number of bytes hashed
         """
-        if not os.path.exists(directory) and not self.download:
-            return None
+        files = {}
+        for media in media_list:
+            if not media.url or not media.md5:
+                continue
+            file = os.path.join(wd, self._basename(media))
+            if file not in files and self._stat(file, self._dir_index.get(wd)):
+                files[file] = media
+        if not files:
+            return files, 0
+        digests, hashed_bytes = self._checksum_store(wd).md5_many(list(files), rehash=self.rehash,
+                                                                  jobs=self.hash_jobs)
+        self._hashed.update(digests)
+        return files, hashed_bytes
+
+    def _media_list(self):
+        """Return all Media in the result that are not excluded, newest first"""
+        exclude = self.exclude_category.split(',')
+        media_list = [x for cat in self.result
+                      if cat.key not in exclude or cat.home
+                      for x in cat.content
+                      if not x.iscategory]
+        return sorted(media_list, key=lambda x: x.date or 0, reverse=True)
 
-        os.makedirs(directory, exist_ok=True)
+    def verify(self, wd=None):
+        """Check MD5 of the local media files, without deleting or downloading anything
 
+        :param wd: directory where the files are saved
+        :return: list of Media whose file doesn't match the checksum
+        """
+        if wd is None:
+            wd = self.work_dir
+        if not os.path.isdir(wd):
+            msg('nothing to verify in {}'.format(wd))
+            return []
+
+        start = time.time()
+        files, hashed_bytes = self._hash_files(self._media_list(), wd)
+        elapsed = time.time() - start
+
+        bad = []
+        for file, media in files.items():
+            if self._hashed[file] != media.md5:
+                msg('checksum mismatch: {}'.format(os.path.basename(file)))
+                bad.append(media)
+        msg('verified {} files, {} mismatched'.format(len(files), len(bad)))
+        msg('hashed {:.0f} MiB in {:.1f} s ({:.1f} MiB/s)'.format(
+            hashed_bytes / 1024**2, elapsed, hashed_bytes / 1024**2 / max(elapsed, 1e-6)))
+        return bad
+
+    def _basename(self, media):
+        """Return the file name media is saved as"""
         base = urllib.parse.urlparse(media.url).path
         if self.title:
             file_extension = os.path.splitext(os.path.basename(base))[-1]
@@ -253,46 +550,133 @@ class JWBroadcasting:
                            ) + file_extension
         else:
             base = os.path.basename(base)
+        return base
+
+    def _msg(self, s, end='\n', file=stderr):
+        """Print a message from a download, one at a time and above the status line"""
+        if self._scheduler:
+            self._scheduler.progress.message(s, end=end, file=file)
+        else:
+            print(s, end=end, file=file, flush=True)
+
+    def _fetch(self, url, file, resume=False, progress=False, size=None):
+        """Download url to file with the built-in client, or curl if there is a curl_path
+
+        When several streams are running, they share the rate limit.
+        Big files are downloaded in segments if :var:`segments` is more than 1.
+
+        :param size: expected file size, if known
+        :return: MD5 of the file if known, else None
+        """
+        # Count what this call adds to the file
+        start = part_size(file) if resume and os.path.exists(file) else 0
+        try:
+            streams = self._scheduler.workers if self._scheduler else 1
+            bucket = self._scheduler.bucket if self._scheduler else None
+            # An unfinished segmented download can only be resumed as such
+            unfinished = resume and os.path.exists(file + '.segments')
+            if unfinished or (not resume and self.segments > 1 and size and size >= self.segment_threshold):
+                if self._scheduler:
+                    def report(n):
+                        self._scheduler.progress.set(file, n)
+                else:
+                    report = None
+                try:
+                    return fetch_segmented(url, file, size, self.segments, bucket=bucket, progress=report)
+                except (OSError, http.client.HTTPException) as e:
+                    self._msg('download error: {}'.format(e))
+                    return None
+
+            if self.curl_path:
+                rate_limit = self.rate_limit
+                if streams > 1 and rate_limit != '0':
+                    # Each curl process gets its share of the total
+                    rate_limit = str(parse_rate(rate_limit) // streams)
+                _curl(url,
+                      file,
+                      resume=resume,
+                      rate_limit=rate_limit,
+                      curl_path=self.curl_path,
+                      # Several progress bars on top of each other is no good
+                      progress=progress and streams == 1,
+                      )
+                return None
+            try:
+                return fetch(url, file, resume=resume, bucket=bucket)
+            except (OSError, http.client.HTTPException) as e:
+                # Like a failed curl - the checks in download_media take it from here
+                self._msg('download error: {}'.format(e))
+                return None
+        finally:
+            if os.path.exists(file):
+                _downloaded_bytes.inc(max(part_size(file) - start, 0))
+
+    def download_media(self, media, directory, check_only=False):
+        """Download media file and check it.
+
+        Download file, check MD5 sum and size, delete file if it missmatches.
+
+        :param media: a Media instance
+        :param directory: dir to save the files to
+        :param check_only: bool, True means no downloading
+        :return: filename, or None if unsuccessful
+        """
+        # When checking, answer from the listing made by prepare_download() if there is one
+        index = self._dir_index.get(directory) if check_only else None
+
+        if index is None:
+            if not os.path.exists(directory) and not self.download:
+                return None
+            os.makedirs(directory, exist_ok=True)
+
+        base = self._basename(media)
 
         # Delete files if same basename in main dir
         if self.type == 'video':
-            for path, dirnames, filenames in os.walk(directory):
-                for filename in filenames:
-                    if filename == base:
-                        pass
-                    elif woext(filename) == woext(base):
-                        os.remove(os.path.join(path, filename))
-                        print('deleted:', os.path.join(path, filename))
-                break
+            variants = (index if index is not None else self._scan_dir(directory)).get(woext(base), {})
+            for filename in list(variants):
+                if filename != base:
+                    self._remove(os.path.join(directory, filename), index)
+                    self._msg('deleted: ' + os.path.join(directory, filename), file=stdout)
         file = os.path.join(directory, base)
         # Only try resuming and downloading once
         resumed = False
         downloaded = False
+        # MD5 of the .part file, if the downloader calculated it
+        digest = None
         progressbar = False if self.subtitles else True
         while True:
 
-            if os.path.exists(file): # os.path.exists(file):
+            st = self._stat(file, index)
+            if st:
 
                 # Set timestamp to date of publishing
                 # NOTE: Do this before checking _checked_files since
                 # this is not done for newly renamed .part files!
-                if media.date:
+                if media.date and st.st_mtime != media.date:
                     os.utime(file, (media.date, media.date))
+                    if file in self._hashed:
+                        # Keep the remembered sum valid for the new timestamp
+                        self._checksum_store(directory).put(file, self._hashed[file])
 
-                if os.path.getsize(file) == media.size or not media.size:
+                if st.st_size == media.size or not media.size:
                     # File size is OK or unknown - Validate checksum
-                    if self.checksums and media.md5 and _md5(file) != media.md5:
+                    if self.checksums and media.md5 and self._checksum(file) != media.md5:
                         # Checksum is bad - Remove
                         if self.quiet < 2:
-                            msg('checksum mismatch, deleting: {}'.format(base))
-                        os.remove(file)
+                            self._msg('checksum mismatch, deleting: {}'.format(base))
+                        _deleted.inc(reason='checksum')
+                        self._checksum_store(directory).forget(file)
+                        self._hashed.pop(file, None)
+                        self._remove(file, index)
                     else:
                         # Checksum is correct
                         return file
                 else:
                     # File size is bad - Delete
-                    msg('size mismatch, deleting: {}'.format(base))
-                    os.remove(file)
+                    self._msg('size mismatch, deleting: {}'.format(base))
+                    _deleted.inc(reason='size')
+                    self._remove(file, index)
 
             elif check_only:
                 # The rest of this method is only applicable in download mode
@@ -301,52 +685,56 @@ class JWBroadcasting:
 
             elif os.path.exists(file + '.part'):
 
-                fsize = os.path.getsize(file + '.part')
+                # Bytes downloaded, also for unfinished segmented downloads
+                fsize = part_size(file + '.part')
 
                 if fsize == media.size or not media.size:
                     # File size is OK - Validate checksum
-                    if self.checksums and media.md5 and _md5(file + '.part') != media.md5:
+                    if self.checksums and media.md5 and (digest or _md5(file + '.part')) != media.md5:
                         # Checksum is bad - Remove
                         if self.quiet < 2:
-                            msg('checksum mismatch, deleting: {}'.format(base + '.part'))
-                        os.remove(file + '.part')
+                            self._msg('checksum mismatch, deleting: {}'.format(base + '.part'))
+                        _deleted.inc(reason='checksum')
+                        remove_part(file + '.part')
+                        digest = None
                     else:
                         # Checksum is correct or unknown - Move and approve
                         os.rename(file + '.part', file)
+                        if media.date:
+                            os.utime(file, (media.date, media.date))
+                        # Remember the sum, so the file doesn't have to be read next time
+                        if digest:
+                            self._checksum_store(directory).put(file, digest)
+                        else:
+                            self._checksum_store(directory).forget(file)
+                        _downloads.inc(result='ok')
                         return file
                 elif fsize < media.size and not resumed:
                     # File is smaller - Resume download once
                     resumed = True
+                    _resumes.inc()
                     if self.quiet < 2:
-                        msg('resuming: {} ({})'.format(base + '.part', media.name))
-                    _curl(media.url,
-                          file + '.part',
-                          resume=True,
-                          rate_limit=self.rate_limit,
-                          curl_path=self.curl_path,
-                          progress=progressbar,
-                          )
+                        self._msg('resuming: {} ({})'.format(base + '.part', media.name))
+                    digest = self._fetch(media.url, file + '.part', resume=True, progress=progressbar, size=media.size)
                 else:
                     # File size is bad - Remove
-                    msg('size mismatch, deleting: {}'.format(base + '.part'))
-                    os.remove(file + '.part')
+                    self._msg('size mismatch, deleting: {}'.format(base + '.part'))
+                    _deleted.inc(reason='size')
+                    remove_part(file + '.part')
+                    digest = None
 
             else:
                 # Download whole file once
                 if not downloaded:
-                    msg('downloading: {} ({})'.format(base, media.name))
-                    _curl(media.url,
-                          file + '.part',
-                          rate_limit=self.rate_limit,
-                          curl_path=self.curl_path,
-                          progress=progressbar,
-                          )
+                    self._msg('downloading: {} ({})'.format(base, media.name))
+                    digest = self._fetch(media.url, file + '.part', progress=progressbar, size=media.size)
                     downloaded = True
                 else:
                     # If we get here, all tests have failed.
                     # Resume and regular download too.
                     # There is nothing left to do.
-                    msg('failed to download: {} ({})'.format(base, media.name))
+                    self._msg('failed to download: {} ({})'.format(base, media.name))
+                    _downloads.inc(result='failed')
                     return None
 
 
@@ -357,69 +745,251 @@ class JWBroadcasting:
         """
         if wd is None:
             wd = self.work_dir
+        if self.rehash:
+            self.checksums = True
+        start = time.monotonic()
 
-        exclude = self.exclude_category.split(',')
-        media_list = [x for cat in self.result
-                      if cat.key not in exclude or cat.home
-                      for x in cat.content
-                      if not x.iscategory]
-        media_list = sorted(media_list, key=lambda x: x.date or 0, reverse=True)
+        media_list = self._media_list()
+
+        # List the work dir once, and answer all existence and size checks from that
+        index = self._scan_dir(wd)
+        if os.path.isdir(wd):
+            self._dir_index[wd] = index
+
+        if self.checksums and os.path.isdir(wd):
+            # Hash all existing files at once, instead of one by one below
+            self._hash_files(media_list, wd)
 
         # Trim down the list of files that need to be downloaded
         download_list = []
-        checked_files = []
+        checked_files = set()
         no_download_list = []
         for media in media_list:
-            if not media.url:
-                continue
-            # Only run this check once per filename
-            path = urllib.parse.urlparse(media.url).path
-            base = os.path.basename(path)
-            if base in checked_files:
-                continue
-            checked_files.append(base)
-
-            # Skip previously deleted files
-            f = urllib.parse.urlparse(media.url).path
-            f = os.path.basename(f)
-            f = os.path.join(wd, f + '.deleted')
-            if os.path.exists(f):
-                continue
-
-            # Search for local media and delete broken files
-            media.file = self.download_media(media, wd, check_only=True)
-
-            if not media.file:
+            needed = self._check(media, wd, checked_files)
+            if needed:
                 download_list.append(media)
-            else:
+            elif needed is False:
                 no_download_list.append(media)
 
+        # Files are about to change, don't trust the listing anymore
+        self._dir_index.pop(wd, None)
+
         self.download_list = download_list
         self.checked_files = checked_files
         self.no_download_list = no_download_list
+        _stage_seconds.set(time.monotonic() - start, stage='prepare_download')
         return download_list
 
+    def _check(self, media, wd, checked_files):
+        """Check if media needs to be downloaded
+
+        :param wd: directory where files will be saved
+        :param checked_files: set of file names checked so far, will be updated
+        :return: True if it must be downloaded, False if the file is fine,
+                 None if it is skipped
+        """
+        if not media.url:
+            _checked.inc(result='no_url')
+            return None
+        # Only run this check once per filename
+        path = urllib.parse.urlparse(media.url).path
+        base = os.path.basename(path)
+        if base in checked_files:
+            _checked.inc(result='duplicate')
+            return None
+        checked_files.add(base)
+
+        # Skip previously deleted files
+        index = self._dir_index.get(wd)
+        if self._stat(os.path.join(wd, base + '.deleted'), index) or \
+                self._stat(os.path.join(wd, self._basename(media) + '.deleted'), index):
+            _checked.inc(result='deleted')
+            return None
+
+        # Search for local media and delete broken files
+        media.file = self.download_media(media, wd, check_only=True)
+        _checked.inc(result='present' if media.file else 'download')
+        return not media.file
+
+    def pipeline_downloads(self, wd=None):
+        """Index, check and download at the same time
+
+        Media from :method:`iter_parse` are checked as soon as they are found,
+        and passed through a bounded queue to the download workers, which start
+        while the index is still being built. Files are downloaded in the order
+        they are found, not newest first.
+
+        :param wd: directory where files will be saved
+        :return: A list containing Category and Media objects, like parse()
+        """
+        if wd is None:
+            wd = self.work_dir
+        if self.rehash:
+            self.checksums = True
+
+        # New files don't show up in this listing, but they have been checked already
+        self._dir_index[wd] = self._scan_dir(wd)
+        queue = queue_module.Queue(maxsize=self.streams * 2)
+        done = object()
+
+        def producer():
+            checked_files = set()
+            try:
+                for media in self.iter_parse():
+                    if self._check(media, wd, checked_files):
+                        queue.put(media)
+            except BaseException as e:
+                queue.put(e)
+            else:
+                queue.put(done)
+
+        def consumer():
+            while True:
+                item = queue.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            with _stage_seconds.time(stage='pipeline_downloads'):
+                self.manage_downloads(wd, consumer())
+        finally:
+            self._dir_index.pop(wd, None)
+        thread.join()
+        return self.result
+
+
+    @staticmethod
+    def _journal_path(directory):
+        return os.path.join(directory, '.jwb-queue.jsonl')
+
+    @staticmethod
+    def _journal_item(media):
+        """Return what the queue journal needs to know about media"""
+        return {'key': media.key, 'name': media.name, 'url': media.url,
+                'md5': media.md5, 'date': media.date, 'size': media.size}
+
+    def resume_downloads(self, wd=None):
+        """Download what is left in the queue journal of an interrupted run
+
+        The crawl and the checks are skipped, the queue is taken as it was.
+        Files that were partly downloaded are resumed.
+
+        :param wd: directory where files will be saved
+        :return: list of Media that were left in the queue
+        """
+        if wd is None:
+            wd = self.work_dir
+        self._setup_client()
+        entries = QueueJournal(self._journal_path(wd)).load()
+        if entries is None:
+            msg('no download queue to resume in {}'.format(wd))
+            return []
+
+        media_list = []
+        for item, state, offset in entries:
+            if state == DONE:
+                continue
+            media = Media()
+            for field, value in item.items():
+                setattr(media, field, value)
+            media_list.append(media)
+        if self.quiet < 1:
+            msg('resuming {} of {} queued downloads'.format(len(media_list), len(entries)))
+
+        self.download_list = media_list
+        self.manage_downloads(wd, media_list)
+        return media_list
 
     def manage_downloads(self, wd=None, download_list=None):
+        """Download the media in download_list
+
+        Up to :var:`streams` files are downloaded at the same time, sharing :var:`rate_limit`.
+        The queue and the state of every download are kept in a journal in wd,
+        so :method:`resume_downloads` can pick up if the run gets interrupted.
 
+        :param wd: directory where files will be saved
+        :param download_list: list (or other iterable) of Media,
+                              default is the list made by prepare_download()
+        """
         if download_list is None:
             download_list = self.download_list
         if wd is None:
             wd = self.work_dir
 
-        for media in download_list:
+        self._scheduler = DownloadScheduler(self.streams, self.rate_limit, self.quiet)
+        evictor = Evictor(wd, self.keep_free, self.quiet, log=self._msg)
+
+        journal = None
+        failed = self.failed = []
+        if self.download:
+            os.makedirs(wd, exist_ok=True)
+            journal = QueueJournal(self._journal_path(wd))
+            if hasattr(download_list, '__len__'):
+                journal.start(self._journal_item(media) for media in download_list)
+            else:
+                # Items are still coming in, add them as they are taken
+                journal.start()
+
+                def journaled(items):
+                    for media in items:
+                        journal.add(self._journal_item(media))
+                        yield media
+
+                download_list = journaled(download_list)
+
+        def job(i, media):
+            if not self.download:
+                return
             # Clean up until there is enough space
             # print(media.name, media.size, media.file, media.url, sep=' | ')
-            space = shutil.disk_usage(wd).free
-            needed = media.size + self.keep_free if media.size else 0
-            if space < needed:
+            if not evictor.make_room(i, media.size or 0, media.date):
+                space = shutil.disk_usage(wd).free
+                needed = (media.size or 0) + self.keep_free
                 s = 'Please, free up hard disk space\n' \
                     'Free space: {:} MiB, needed: {:} MiB'.format(space//1024**2, needed//1024**2)
                 raise Exception(s)
             # Download the video
-            if self.download:
-                print('[{}/{}]'.format(download_list.index(media) + 1, len(download_list)), end=' ', file=stderr)
-                media.file = self.download_media(media, wd)
+            part = os.path.join(wd, self._basename(media)) + '.part'
+            try:
+                if self.streams == 1:
+                    self._msg('[{}/{}]'.format(i + 1, self._scheduler.progress.total), end=' ')
+                journal.set(i, PARTIAL, offset=part_size(part) if os.path.exists(part) else 0)
+                self._scheduler.progress.add(part, media.size, media.name)
+                with _download_seconds.time():
+                    media.file = self.download_media(media, wd)
+                self._scheduler.progress.remove(part)
+                if media.file:
+                    evictor.add(media.file)
+                    journal.set(i, DONE)
+                else:
+                    failed.append(media)
+                    journal.set(i, FAILED)
+            except BaseException:
+                # Note how far it got, for the next run
+                if journal:
+                    journal.set(i, PARTIAL, offset=part_size(part) if os.path.exists(part) else 0)
+                raise
+            finally:
+                evictor.release(i)
+
+        finished = False
+        try:
+            with _stage_seconds.time(stage='manage_downloads'):
+                self._scheduler.run(download_list, job)
+            finished = True
+        finally:
+            self._scheduler = None
+            if journal:
+                # Keep the journal if anything is left to do
+                if finished and not failed:
+                    journal.remove()
+                else:
+                    journal.close()
 
 
 class JWPubMedia(JWBroadcasting):
@@ -427,16 +997,22 @@ class JWPubMedia(JWBroadcasting):
     book = 0
     # Disable rate limit completely
     rate_limit = '0'
-    curl_path = 'curl'
+    curl_path = None
+    # The Bible index is 67 small requests
+    jobs = 8
+    # API location, can be pointed to a local server for testing
+    pubmedia_url = 'https://pubmedia.jw-api.org/GETPUBMEDIALINKS'
     quality = 720
     lang = 'S'
 
-    def parse(self):
+    def iter_parse(self):
         """Index JW org sound recordings
 
-        :return: a list containing Category and Media objects
+        Books are added to :var:`result` like :method:`parse` does.
+
+        :return: generator of Media objects, as soon as their book is decoded
         """
-        url_template = 'https://pubmedia.jw-api.org/GETPUBMEDIALINKS' \
+        url_template = self.pubmedia_url + \
                        '?output=json&alllangs={a}&langwritten={L}&txtCMSLang={L}&pub={p}'
         rawpub = self.pub
         # Watchtower/Awake reference is split up into pub and issue
@@ -451,70 +1027,97 @@ class JWPubMedia(JWBroadcasting):
 
         # Check language code
         # This must be done after the magazine stuff
-        # We want the languages for THAT publication only, or else the list gets SOO long
-        # The language is checked on the first pub in the queue
-        url = url_template.format(L='E', p=self.pub, i=queue[0], a='1')
-
-        with urllib.request.urlopen(url) as response:
-            response = json.loads(response.read().decode())
-
-            # Check if the code is valid
-            if self.lang not in response['languages']:
-                msg('language codes:')
-                for lang in sorted(response['languages'], key=lambda x: response['languages'][x]['name']):
-                    msg('{:>3}  {:<}'.format(lang, response['languages'][lang]['name']))
-                raise ValueError(self.lang + ': invalid language code')
+        # Codes in the language catalog are trusted without asking the server
+        # Otherwise we want the languages for THAT publication only, or else the list gets SOO long
+        # The language list comes with the first pub in the queue, so it costs no extra request
+        self._open_cache()
+        check_lang = not catalog.is_valid(self.lang)
+        bible = self.pub == 'bi12' or self.pub == 'nwt'
+
+        # Books are fetched in parallel, but handled in queue order
+        # so they end up in the result in canonical order
+        pool = ThreadPoolExecutor(max_workers=max(self.jobs, 1))
+
+        def get(key, alllangs=0):
+            url = url_template.format(L=self.lang, p=self.pub, i=key, a=alllangs)
+            try:
+                return url, self._get_json(url)
+            except urllib.error.HTTPError:
+                return url, None
+
+        futures = [pool.submit(get, queue[0], int(check_lang))]
         print('Getting url...')
         bare = True
-        for key in queue:
-            url = url_template.format(L=self.lang, p=self.pub, i=key, a=0)
-            # print('URL:', url)
-            book = Category()
-            self.result.append(book)
-
-            if self.pub == 'bi12' or self.pub == 'nwt':
-                book.key = format(int(key), '02')
-                # This is the starting point if the value in the queue
-                # is the same as the one the user specified
-                book.home = key == self.book
-            else:
-                book.key = self.pub
-                book.home = True
-            try:
-                with urllib.request.urlopen(url) as response:
-                    response = json.loads(response.read().decode())
-                    book.name = response['pubName']
-
-                    if self.quiet < 1:
-                        msg('{} {}'.format(book.key, book.name))
-
-                    # For the Bible's index page
-                    # Add all books to the queue
-                    if key == 0 and (self.pub == 'bi12' or self.pub == 'nwt'):
-                        for i in range(1, 67):
-                            queue.append(i)
-
-                    for fileformat in response['files'][self.lang]:
-                        for chptr in response['files'][self.lang][fileformat]:
-                            if self.type == 'video' and \
-                                    int(chptr['label'][:-1]) != self.quality:
-                                # not match quality
-                                continue
-                            # match mimetype
-                            if chptr['mimetype'].startswith(self.type) or \
-                                    chptr['mimetype'].endswith(self.type):
-                                m = Media()
-                                m.url = chptr['file']['url']
-                                m.name = chptr['title'].replace('&nbsp;', ' ')
-                                m.md5 = chptr['file']['checksum']
-                                if 'filesize' in chptr:
-                                    m.size = chptr['filesize']
-
-                                book.add(m)
-                                bare = False
+        try:
+            for i, key in enumerate(queue):
+                url, response = futures[i].result()
+                futures[i] = None
+
+                if i == 0 and check_lang:
+                    languages = response and response.get('languages')
+                    if not languages:
+                        # The server didn't take the code, get the list in English instead
+                        languages = self._get_json(url_template.format(L='E', p=self.pub, i=key, a=1))['languages']
+                    # Check if the code is valid
+                    if self.lang not in languages:
+                        msg('language codes:')
+                        for lang in sorted(languages, key=lambda x: languages[x]['name']):
+                            msg('{:>3}  {:<}'.format(lang, languages[lang]['name']))
+                        raise ValueError(self.lang + ': invalid language code')
+
+                # print('URL:', url)
+                book = Category()
+                self.result.append(book)
+
+                if bible:
+                    book.key = format(int(key), '02')
+                    # This is the starting point if the value in the queue
+                    # is the same as the one the user specified
+                    book.home = key == self.book
+                else:
+                    book.key = self.pub
+                    book.home = True
+
+                if response is None:
+                    continue
+                book.name = response['pubName']
+
+                if self.quiet < 1:
+                    msg('{} {}'.format(book.key, book.name))
+
+                # For the Bible's index page
+                # Add all books to the queue
+                if key == 0 and bible:
+                    for n in range(1, 67):
+                        queue.append(n)
+                        futures.append(pool.submit(get, n))
+
+                for fileformat in response['files'][self.lang]:
+                    for chptr in response['files'][self.lang][fileformat]:
+                        if self.type == 'video' and \
+                                int(chptr['label'][:-1]) != self.quality:
+                            # not match quality
+                            continue
+                        # match mimetype
+                        if chptr['mimetype'].startswith(self.type) or \
+                                chptr['mimetype'].endswith(self.type):
+                            m = Media()
+                            m.url = chptr['file']['url']
+                            m.name = chptr['title'].replace('&nbsp;', ' ')
+                            m.md5 = chptr['file']['checksum']
+                            if 'filesize' in chptr:
+                                m.size = chptr['filesize']
+
+                            book.add(m)
+                            bare = False
+                            yield m
+        finally:
+            # Don't wait for requests nobody is going to read
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+            pool.shutdown()
 
-            except urllib.error.HTTPError:
-                pass
         if bare:
             s = (f'It seems that there are no {self.type} files in {self.lang} '
                  f'language for {rawpub} publication')
@@ -524,16 +1127,12 @@ class JWPubMedia(JWBroadcasting):
             msg(f'Check this URL: {url}')
         else:
             print('...done\n')
-        return self.result
 
 
-def _md5(file):
-    """Return MD5 of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def _get_json(url):
+    """Fetch an URL and return the decoded JSON response."""
+    with urlopen(url) as response:
+        return json.loads(response.read().decode())
 
 
 def _curl(url, file, resume=False, rate_limit='0', curl_path='curl', progress=False):
@@ -554,43 +1153,41 @@ def _curl(url, file, resume=False, rate_limit='0', curl_path='curl', progress=Fa
             proc.append('-')
 
         subprocess.call(proc, stderr=stderr)
-        print('\033[F\033[K', end='', flush=True)
+        if progress:
+            # Remove the progress bar
+            print('\033[F\033[K', end='', flush=True)
 
     else:
-        # If there is no rate limit, use urllib (for compatibility)
-        request = urllib.request.Request(url)
-        file_mode = 'wb'
-
-        if resume:
-            # Ask server to skip the first N bytes
-            request.add_header('Range', 'bytes={}-'.format(os.stat(file).st_size))
-            # Append data to file, instead of overwriting
-            file_mode = 'ab'
-
-        response = urllib.request.urlopen(request)
-
-        # Write out 1MB at a time, so whole file is not lost if interrupted
-        with open(file, file_mode, encoding='utf-8') as f:
-            while True:
-                chunk = response.read(1024 * 1024)
-                if not chunk:
-                    break
-                f.write(chunk)
+        # If there is no rate limit, use the built-in client (for compatibility)
+        fetch(url, file, resume=resume)
 
 
 class Category:
-    """Object to put category info in."""
+    """Object to put category info in.
+
+    Slots instead of a __dict__, since a full crawl keeps a lot of these around.
+    """
+    __slots__ = ('_key', 'name', 'home', 'position', 'content')
     iscategory = True
-    key = None
-    name = None
-    # Whether or not this is a "starting point"
-    home = False
-    # Used for streaming
-    position = 0
 
     def __init__(self):
+        self._key = None
+        self.name = None
+        # Whether or not this is a "starting point"
+        self.home = False
+        # Used for streaming
+        self.position = 0
         self.content = []
 
+    @property
+    def key(self):
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        # The same keys show up in many places, keep only one copy
+        self._key = sys.intern(key) if key is not None else None
+
     def add(self, obj):
         """Add an object to :var:`self.content`
 
@@ -600,11 +1197,35 @@ class Category:
 
 
 class Media:
-    """Object to put media info in."""
+    """Object to put media info in.
+
+    Slots instead of a __dict__, since there may be hundreds of thousands of
+    these. The URL is kept as an interned directory part, which many files
+    share, and the file name.
+    """
+    __slots__ = ('key', 'name', 'md5', 'date', 'size', 'file', '_url_dir', '_url_name')
     iscategory = False
-    url = None
-    name = None
-    md5 = None
-    date = None
-    size = None
-    file = None
+
+    def __init__(self):
+        self.key = None
+        self.name = None
+        self.md5 = None
+        self.date = None
+        self.size = None
+        self.file = None
+        self._url_dir = None
+        self._url_name = None
+
+    @property
+    def url(self):
+        if self._url_name is None:
+            return None
+        return self._url_dir + self._url_name
+
+    @url.setter
+    def url(self, url):
+        if url is None:
+            self._url_dir = self._url_name = None
+        else:
+            directory, slash, self._url_name = url.rpartition('/')
+            self._url_dir = sys.intern(directory + slash)
@@ -6,12 +6,15 @@ import re
 import json
 import platform
 import ctypes
+import threading
 from subprocess import run
 from os.path import join as pj
-import urllib.request
-import urllib.parse
 from sys import stderr
 
+from jwlib.atomic import atomic_write_json
+from jwlib.client import urlopen
+from jwlib.languages import catalog
+
 
 def msg(s):
     print(s, file=stderr, flush=True)
@@ -36,19 +39,15 @@ def parse_num_book(lang):
         url_template = 'https://pubmedia.jw-api.org/GETPUBMEDIALINKS' \
                        '?output=json&alllangs=0&langwritten={L}&txtCMSLang={L}' \
                        '&pub=nwt&booknum={i}'
+        if not catalog.is_valid(lang):
+            catalog.print_codes()
+            raise ValueError(lang + ': invalid language code')
         num_book = {}
         print(f'Getting booknum and bookname in {lang} language')
         for i in range(1, 67):
             url = url_template.format(L=lang, i=i)
-            with urllib.request.urlopen(url) as response:
+            with urlopen(url) as response:
                 response = json.loads(response.read().decode())
-                # Check if the code is valid
-                if lang not in response['languages']:
-                    msg('language codes:')
-                    for language in sorted(response['languages'], key=lambda x: response['languages'][x]['name']):
-                        msg('{:>3}  {:<}'.format(language, response['languages'][language]['name']))
-                    raise ValueError(lang + ': invalid language code')
-                    exit()
                 num_book.setdefault(format(i, '02'), response['pubName'])
                 print(format(i, '02'), response['pubName'])
         os.makedirs(os.path.dirname(dir_file), exist_ok=True)
@@ -72,19 +71,104 @@ def woext(filename):
     return os.path.splitext(os.path.basename(filename))[0]
 
 
-def probe_markers(filename):
-    """
-    Returns markers (chapters) from filename with ffprobe
+class ProbeCache:
+    """What ffprobe says about videos, kept on disk between runs
+
+    Entries are keyed by path, and only used while the size and the
+    modification time of the file are the same as when it was probed.
     """
-    console = run(['ffprobe', '-v', 'quiet', '-show_chapters',
+
+    def __init__(self):
+        self.path = None
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        """Read the cache from path, where :method:`save` will write it"""
+        try:
+            with open(path, 'r', encoding='utf-8') as json_file:
+                entries = json.load(json_file)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        with self._lock:
+            self.path = path
+            self._entries = entries
+            self._dirty = False
+
+    def save(self):
+        """Write the cache, if it changed, leaving out files that are gone"""
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            entries = {video: entry for video, entry in self._entries.items() if os.path.exists(video)}
+            atomic_write_json(self.path, entries, ensure_ascii=False)
+            self._entries = entries
+            self._dirty = False
+
+    def _lookup(self, video, field, prober):
+        try:
+            stat = os.stat(video)
+        except OSError:
+            # Let ffprobe tell what is wrong
+            return prober(video)
+        with self._lock:
+            entry = self._entries.get(video)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                if field in entry:
+                    return entry[field]
+            else:
+                entry = None
+        # Outside the lock, so other videos can be probed meanwhile
+        value = prober(video)
+        if value is None:
+            return None
+        with self._lock:
+            if entry is None:
+                entry = self._entries[video] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            entry[field] = value
+            self._dirty = True
+        return value
+
+    def probe(self, video):
+        """Return chapters, format and streams of video, see :func:`probe`"""
+        return self._lookup(video, 'probe', _run_probe)
+
+    def keyframes(self, video):
+        """Return codec and keyframe times of video, see :func:`probe_keyframes`"""
+        value = self._lookup(video, 'keyframes', _run_probe_keyframes)
+        return tuple(value) if value else (None, [])
+
+
+# Shared by everyone, JWSigns loads and saves it in db/probe.json
+probes = ProbeCache()
+
+
+def _run_probe(filename):
+    console = run(['ffprobe', '-v', 'quiet', '-show_chapters', '-show_format', '-show_streams',
                    '-print_format', 'json', filename
                    ],
                   capture_output=True)
     if console.returncode == 0:
-        return json.loads(console.stdout.decode('utf-8'))['chapters']
+        return json.loads(console.stdout.decode('utf-8'))
     else:
         print(f'error {filename}')
-        return []
+
+
+def probe(filename):
+    """
+    Returns chapters, format and streams of filename, as given by ffprobe
+    in json, or None if it can't be probed. Cached in :data:`probes`.
+    """
+    return probes.probe(filename)
+
+
+def probe_markers(filename):
+    """
+    Returns markers (chapters) from filename with ffprobe
+    """
+    data = probe(filename)
+    return data.get('chapters', []) if data else []
 
 
 def parse_markers_raw(markers, filename):
@@ -184,29 +268,57 @@ def get_chptr_verse(raw_title):
 
 
 def probe_general(video):
-    cmd_probe_general = ['ffprobe', '-v', 'quiet', '-show_format',
-                         '-print_format', 'json', video]
-    console = run(cmd_probe_general, capture_output=True)
-    return json.loads(console.stdout.decode('utf-8'))
+    data = probe(video)
+    return {'format': data.get('format', {})} if data else {}
+
+
+def _run_probe_keyframes(video):
+    console = run(['ffprobe', '-v', 'quiet', '-select_streams', 'v:0',
+                   '-show_entries', 'stream=codec_name:packet=pts_time,flags',
+                   '-print_format', 'json', video
+                   ],
+                  capture_output=True)
+    if console.returncode != 0:
+        print(f'error {video}')
+        return None
+    data = json.loads(console.stdout.decode('utf-8'))
+    streams = data.get('streams') or [{}]
+    keyframes = sorted(float(packet['pts_time']) for packet in data.get('packets', [])
+                       if 'K' in packet.get('flags', '') and packet.get('pts_time', 'N/A') != 'N/A')
+    return [streams[0].get('codec_name'), keyframes]
+
+
+def probe_keyframes(video):
+    """
+    Returns the codec of the first video stream and the times of its keyframes,
+    read from the packets, without decoding anything. Cached in :data:`probes`.
+    """
+    return probes.keyframes(video)
+
+
+def video_stream(video):
+    """
+    Returns the first video stream of video as given by ffprobe, or None
+    """
+    data = probe(video)
+    for stream in (data or {}).get('streams', []):
+        if stream.get('codec_type') == 'video':
+            return stream
 
 
 def ffprobe_signature(video):
-    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format_tags=genre',
-           '-of', 'default=noprint_wrappers=1:nokey=1', video]
-    console = run(cmd, capture_output=True)
-    return console.stdout.decode('utf-8').strip()
+    data = probe(video)
+    tags = (data or {}).get('format', {}).get('tags', {})
+    # Tag names keep the case of the container
+    return next((value for key, value in tags.items() if key.lower() == 'genre'), '').strip()
 
 
 def ffprobe_height(video):
-    cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'stream=height',  '-of',
-           'default=noprint_wrappers=1:nokey=1', '-select_streams', 'v:0',
-           video]
-    console = run(cmd, capture_output=True)
-    height = console.stdout.decode('utf-8')
+    stream = video_stream(video)
     try:
-        return int(height)
-    except ValueError:
-        print(height, 'no se pudo')
+        return int(stream['height'])
+    except (TypeError, KeyError, ValueError):
+        print(video, 'no se pudo')
         pass
 
 
@@ -2,20 +2,23 @@
 
 import os
 import json
+import time
 import threading
-import io
 from subprocess import run
 import shlex
-from PIL import Image
+import numpy as np
 
 from os.path import join as pj
 from io import UnsupportedOperation
+from concurrent.futures import ThreadPoolExecutor
 from json.decoder import JSONDecodeError
 
+from jwlib.atomic import atomic_write_json
 from signs.constants import (
-    probe_markers, parse_markers_nwt, parse_markers_raw, ext, woext,
+    probe_markers, parse_markers_nwt, parse_markers_raw, woext,
     parse_num_book, attrib_hidden, ffprobe_signature,
-    get_nwt_video_info, add_numeration, ffprobe_height, run_progress_bar
+    get_nwt_video_info, add_numeration, ffprobe_height, run_progress_bar,
+    probe_keyframes, video_stream, probes
 )
 
 class JWSigns:
@@ -30,6 +33,19 @@ class JWSigns:
     hwaccel = False
     hevc = False
     raw = False
+    # Number of videos to split at the same time
+    jobs = 1
+    # Split all verses of a video with one ffmpeg run, at most this many at a time
+    single_pass = False
+    single_pass_outputs = 16
+    # Cut verses that need no side bars without encoding them again
+    stream_copy = False
+    # A keyframe this close to the start of a verse is taken as its start, in seconds
+    keyframe_tolerance = 0.01
+    # Frames are scaled to this size (width, height) to find the side bar colors
+    probe_size = (640, 360)
+    # Corners darker than this, in every channel, are taken as black
+    black_level = 16
 
     def __init__(self):
         pass
@@ -39,6 +55,7 @@ class JWSigns:
         os.makedirs(dir, exist_ok=True)
         attrib_hidden(dir)
         self.dirdb = pj(dir, 'db.json')
+        probes.load(pj(dir, 'probe.json'))
         if not os.path.exists(self.dirdb):
             self.db = {}
         else:
@@ -121,6 +138,7 @@ class JWSigns:
                     result.append(mark)
             self.db[woext(video)] = os.stat(video).st_size
         self.write_json(self.db)
+        probes.save()
         print('raw', verse_videos)
         return result
 
@@ -156,58 +174,290 @@ class JWSigns:
                     result.append(mark)
             self.db[woext(video)] = os.stat(video).st_size
         self.write_json(self.db)
+        probes.save()
         print(f'{len(result)} found\n')
         return result
 
     def cook(self, result):
+        """Split the videos in result, up to :var:`jobs` at the same time
+
+        With :var:`single_pass`, the verses of each parent video are split by
+        one ffmpeg run per :var:`single_pass_outputs` verses, instead of one
+        run per verse.
+
+        If a split fails, no more are started, the running ones are finished
+        and False is returned.
+
+        :return: True if all went well
+        """
         if not result:
             print('Everything is ok. There is no work to do.')
-            return
+            return True
         print('Splitting videos...')
         total = len(result)
         format_spec = f'0{len(str(total))}'
-        for i, task in enumerate(result, start=1):
-            print(f'[{format(i, format_spec)}/{total}]\t', task['title'], end='\t-->\t', flush=True)
-            if self.raw is True:
-                color = False
-                outvid = pj(self.work_dir,
-                            f"{format(i, '02')} {task['title']}{ext(task['parent'])}")
+        jobs = max(self.jobs, 1)
+        # Share the CPU between the ffmpeg instances, instead of each one taking all of it
+        threads = max((os.cpu_count() or 1) // jobs, 1) if jobs > 1 else None
+        # One line per verse, with a spinner while it is being split
+        spinner = jobs == 1 and not self.single_pass
+        self._lock = threading.Lock()
+        self._saved = time.monotonic()
+        heights = {}
+        colors = {}
+        if self.raw is not True:
+            # Every parent video costs one ffmpeg run for all its verses, plus one ffprobe for its height
+            starts = {}
+            for task in result:
+                starts.setdefault(task['parent'], []).append(task['start'])
+
+            def detect(parent):
+                heights[parent] = ffprobe_height(parent)
+                colors[parent] = dict(zip(starts[parent], self._verificaBordes(parent, starts[parent])))
+
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                for future in [pool.submit(detect, parent) for parent in starts]:
+                    future.result()
+        stop = threading.Event()
+        failures = []
+        done = [0]
+
+        numbered = list(enumerate(result, start=1))
+        if self.single_pass:
+            groups = {}
+            for i, task in numbered:
+                groups.setdefault(task['parent'], []).append((i, task))
+            batches = [group[n:n + self.single_pass_outputs]
+                       for group in groups.values()
+                       for n in range(0, len(group), self.single_pass_outputs)]
+        else:
+            batches = [[item] for item in numbered]
+
+        def job(batch):
+            if stop.is_set():
+                return
+            segments = []
+            for i, task in batch:
+                if self.raw is True:
+                    color = False
+                    height = None
+                    outdir = self.work_dir
+                    name = f"{format(i, '02')} {task['title']}"
+                else:
+                    outdir = pj(self.work_dir, task['booknum'] + ' ' + self.num_bookname[task['booknum']])
+                    name = task['title']
+                    height = heights[task['parent']]
+                    color = colors[task['parent']][task['start']]
+                segments.append({'task': task, 'start': task['start'], 'end': task['end'],
+                                 'outdir': outdir, 'name': name, 'color': color, 'height': height})
+
+            copies = [seg for seg in segments if self.stream_copy and seg['color'] is False]
+            encodes = [seg for seg in segments if seg not in copies]
+            parts = [[seg] for seg in copies]
+            if self.single_pass and encodes:
+                parts.append(encodes)
             else:
-                outdir = pj(self.work_dir, task['booknum'] + ' ' + self.num_bookname[task['booknum']])
-                name = task['title']
-                color = self._verificaBordes(task['parent'], task['start'])
-
-            self.finished_event = threading.Event()
-            progress_bar_thread = threading.Thread(target=run_progress_bar, args=(self.finished_event,))
-            progress_bar_thread.start()
-            process = self.split_video(
-                input=task['parent'],
-                start=task['start'],
-                end=task['end'],
-                outdir=outdir,
-                name=name,
-                color=color,
+                parts.extend([seg] for seg in encodes)
+
+            if spinner:
+                i, task = batch[0]
+                print(f'[{format(i, format_spec)}/{total}]\t', task['title'], end='\t-->\t', flush=True)
+                self.finished_event = threading.Event()
+                progress_bar_thread = threading.Thread(target=run_progress_bar, args=(self.finished_event,))
+                progress_bar_thread.start()
+            runs = []
+            for part in parts:
+                process = self._split(part, threads)
+                runs.append((part, process))
+                if process.returncode != 0:
+                    break
+            if spinner:
+                self.finished_event.set()
+                progress_bar_thread.join()
+
+            with self._lock:
+                for segments, process in runs:
+                    if process.returncode == 0:
+                        for seg in segments:
+                            done[0] += 1
+                            if spinner:
+                                print('done')
+                            else:
+                                print(f'[{format(done[0], format_spec)}/{total}]\t', seg['task']['title'],
+                                      '\t-->\tdone', flush=True)
+                            self.ready.update({seg['name']: os.stat(pj(seg['outdir'], seg['name'] + '.mp4')).st_size})
+                        self._save_ready()
+                    else:
+                        stop.set()
+                        seg = segments[0]
+                        failures.append(seg['task'])
+                        print(
+                            f'\nUps! Something was wrong\nVideo input: "{pj(seg["outdir"], seg["name"])}"\n'
+                            f'hwaccel: {self.hwaccel}\nhevc: {self.hevc}\n16:9 {not bool(seg["color"])}\n'
+                            f'start: {seg["start"]}\nend: {segments[-1]["end"]}'
+                        )
+
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(job, batch) for batch in batches]
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            with self._lock:
+                self._save_ready(force=True)
+            probes.save()
+        return not failures
+
+    def _split(self, segments, threads=None):
+        """Split segments of one video, all in one go if there are more than one
+
+        :return: the finished process
+        """
+        seg = segments[0]
+        if self.stream_copy and seg['color'] is False:
+            return self.split_video_copy(
+                input=seg['task']['parent'],
+                start=seg['start'],
+                end=seg['end'],
+                outdir=seg['outdir'],
+                name=seg['name'],
                 hwaccel=self.hwaccel,
                 hevc=self.hevc,
+                threads=threads,
                 )
-            self.finished_event.set()
-            progress_bar_thread.join()
-            if process.returncode == 0:
-                print('done')
-                self.ready.update({name: os.stat(pj(outdir, name + '.mp4')).st_size})
-            else:
-                print(
-                    f'\nUps! Something was wrong\nVideo input: "{pj(outdir, name)}"\n'
-                    f'hwaccel: {self.hwaccel}\nhevc: {self.hevc}\n16:9 {not bool(color)}\n'
-                    f'start: {task["start"]}\nend: {task["end"]}'
+        if len(segments) > 1:
+            return self.split_video_multi(
+                input=seg['task']['parent'],
+                segments=segments,
+                hwaccel=self.hwaccel,
+                hevc=self.hevc,
+                threads=threads,
                 )
-                exit(1)
+        return self.split_video(
+            input=seg['task']['parent'],
+            start=seg['start'],
+            end=seg['end'],
+            outdir=seg['outdir'],
+            name=seg['name'],
+            color=seg['color'],
+            height=seg['height'],
+            hwaccel=self.hwaccel,
+            hevc=self.hevc,
+            threads=threads,
+            )
+
+    def _save_ready(self, force=False):
+        """Write ready.json, at most every few seconds unless forced
+
+        Must be called with the lock held.
+        """
+        if not force and time.monotonic() - self._saved < 5:
+            return
+        atomic_write_json(pj(self.work_dir, 'db', 'ready.json'), self.ready, ensure_ascii=False, indent=4)
+        self._saved = time.monotonic()
+
+    @staticmethod
+    def _drawbox(color, height):
+        """Return the filter that paints the side bars of a 16:9 frame with color (left, right)"""
+        delta = int(height * 4 / 3 * 0.02)  # 2% security
+        width_bar = int((height * 16 / 9 - height * 4 / 3) / 2) + delta
+        x_offset = int(height * 16 / 9 - width_bar)
+        return (f'drawbox=x=0:y=0:w={width_bar}:h={height}:color={color[0]}:t=fill, '
+                f'drawbox=x={x_offset}:y=0:w={width_bar}:h={height}:color={color[1]}:t=fill')
+
+    @staticmethod
+    def _encoder(hwaccel=False, hevc=False, threads=None):
+        """Return the encoder options for ffmpeg"""
+        if hevc:
+            encodeHW = '-c:v hevc_nvenc -cq:v 31 '
+            encodeCPU = '-c:v libx265 '
+        else:
+            encodeHW = '-c:v h264_nvenc -cq:v 26 '
+            encodeCPU = '-c:v libx264 '
+        encode = encodeHW if hwaccel else encodeCPU
+        if threads:
+            encode += f'-threads {threads} '
+        return encode
+
+    @staticmethod
+    def _head_encoder(stream, codec, hwaccel=False, threads=None):
+        """Return encoder options that give the same kind of stream as the source
+
+        Used for the frames put in front of copied packets, which end up in
+        the same track. Profile, level, pixel format and size are taken from
+        the probed source stream.
+
+        :param stream: the video stream of the source, as given by ffprobe
+        :param codec: h264 or hevc
+        :return: list of options, or None if the encoder can't match the source
+        """
+        if hwaccel:
+            encoder = {'h264': 'h264_nvenc', 'hevc': 'hevc_nvenc'}[codec]
+        else:
+            encoder = {'h264': 'libx264', 'hevc': 'libx265'}[codec]
+        profiles = {
+            'libx264': {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main',
+                        'High': 'high', 'High 10': 'high10', 'High 4:2:2': 'high422',
+                        'High 4:4:4 Predictive': 'high444'},
+            'h264_nvenc': {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main',
+                           'High': 'high', 'High 4:4:4 Predictive': 'high444p'},
+            'libx265': {'Main': 'main', 'Main 10': 'main10'},
+            'hevc_nvenc': {'Main': 'main', 'Main 10': 'main10', 'Rext': 'rext'},
+        }[encoder]
+        profile = profiles.get(stream.get('profile'))
+        try:
+            # ffprobe gives the level times 10 for H.264 and times 30 for HEVC
+            level = int(stream['level']) / (10 if codec == 'h264' else 30)
+            size = '{}x{}'.format(int(stream['width']), int(stream['height']))
+            pix_fmt = stream['pix_fmt']
+        except (KeyError, TypeError, ValueError):
+            return None
+        if profile is None or level <= 0:
+            return None
+        level = format(level, '.1f')
 
-        path = pj(self.work_dir, 'db', 'ready.json')
-        with open(path, 'w', encoding='utf-8') as jsonfile:
-            json.dump(self.ready, jsonfile, ensure_ascii=False, indent=4)
+        args = ['-c:v', encoder, '-profile:v', profile, '-pix_fmt', pix_fmt, '-s', size]
+        if encoder == 'libx265':
+            args += ['-x265-params', f'level-idc={level}']
+        else:
+            args += ['-level', level]
+        if hwaccel:
+            args += ['-cq:v', '26' if codec == 'h264' else '31']
+        if threads:
+            args += ['-threads', str(threads)]
+        return args
+
+    @staticmethod
+    def _finish(bareoutput, success):
+        """Put a finished .part file in place, or remove it after an error"""
+        if success:
+            try:
+                os.remove(bareoutput + '.mp4')
+            except FileNotFoundError:
+                pass
+            finally:
+                os.rename(bareoutput + '.part', bareoutput + '.mp4')
+        else:
+            try:
+                os.remove(bareoutput + '.part')
+            except FileNotFoundError:
+                pass
 
-    def split_video(self, input, start, end, outdir, name, color=None, hwaccel=False, hevc=False):
+    def _print_error(self, console):
+        err = console.stderr.decode('utf-8')
+        print(err)
+        if self.hwaccel and any(elem in err.casefold() for elem in ['cuda', 'cuvid', 'nvidia', 'hwaccel']):
+            print('\nTranscoding with hardware acceleration is not possible. '
+                  'It is probably due to one of these 3 cases:\n'
+                  '\t- You do not have a dedicated graphics card.\n'
+                  '\t- You do not have a compatible graphics card.\n'
+                  '\t- You don\'t have the Nvidia software installed.\n\n'
+                  'Please visit https://github.com/vbastianpc/jw-scripts/wiki/jw-signs-(E)'
+            )
+
+    def split_video(self, input, start, end, outdir, name, color=None, height=None, hwaccel=False, hevc=False,
+                    threads=None):
         os.makedirs(outdir, exist_ok=True)
         bareoutput = pj(outdir, name)
         prelude = f'ffmpeg -y -loglevel warning -hide_banner -ss {str(start)} '
@@ -219,82 +469,201 @@ class JWSigns:
             '-metadata comment=https://github.com/vbastianpc/jw-scripts '
         )
         if color:
-            height = self.current_height
-            delta = int(height * 4 / 3 * 0.02)  # 2% security
-            width_bar = int((height * 16 / 9 - height * 4 / 3) / 2) + delta
-            x_offset = int(height * 16 / 9 - width_bar)
-            core += ('-vf '
-                f'"drawbox=x=0:y=0:w={width_bar}:h={height}:color={color[0]}:t=fill, '
-                f'drawbox=x={x_offset}:y=0:w={width_bar}:h={height}:color={color[1]}:t=fill" '
-                )
-        if hevc:
-            encodeHW = '-c:v hevc_nvenc -cq:v 31 '
-            encodeCPU = '-c:v libx265 '
-        else:
-            encodeHW = '-c:v h264_nvenc -cq:v 26 '
-            encodeCPU = '-c:v libx264 '
+            core += f'-vf "{self._drawbox(color, height)}" '
         end = f'-f mp4 \"{bareoutput + ".part"}\" '
 
         if hwaccel:
-            cmd = prelude + decodeHW + core + encodeHW + end
+            cmd = prelude + decodeHW + core + self._encoder(hwaccel, hevc, threads) + end
         else:
-            cmd = prelude + core + encodeCPU + end
+            cmd = prelude + core + self._encoder(hwaccel, hevc, threads) + end
 
         # https://superuser.com/questions/1320389/updating-mp4-chapter-times-and-names-with-ffmpeg
 
         console = run(shlex.split(cmd), capture_output=True)
 
-        if console.returncode == 0: # success
-            try:
-                os.remove(bareoutput + '.mp4')
-            except FileNotFoundError:
-                pass
-            finally:
-                os.rename(bareoutput + '.part', bareoutput + '.mp4')
-        else: # error
+        self._finish(bareoutput, console.returncode == 0)
+        if console.returncode != 0:
+            self._print_error(console)
+        return console
+
+    def split_video_multi(self, input, segments, hwaccel=False, hevc=False, threads=None):
+        """Split several verses of one video with a single ffmpeg run
+
+        The video is opened and decoded once, from the start of the first
+        verse. Every verse is an output of its own, cut with output -ss and
+        -t, with its own metadata and side bar colors.
+
+        :param segments: list of dicts with start, end, outdir, name, color and height
+        :return: the finished process, all outputs failed if it failed
+        """
+        first = min(seg['start'] for seg in segments)
+        cmd = ['ffmpeg', '-y', '-loglevel', 'warning', '-hide_banner', '-ss', str(first)]
+        if hwaccel:
+            cmd += ['-hwaccel', 'cuda']
+        cmd += ['-i', input]
+        for seg in segments:
+            os.makedirs(seg['outdir'], exist_ok=True)
+            # Timestamps start at 0 after the input seek
+            cmd += ['-ss', str(seg['start'] - first), '-t', str(seg['end'] - seg['start']),
+                    '-map_chapters', '-1',
+                    '-metadata', f"title={seg['name']}", '-metadata', 'genre=vbastianpc',
+                    '-metadata', 'comment=https://github.com/vbastianpc/jw-scripts']
+            if seg['color']:
+                cmd += ['-vf', self._drawbox(seg['color'], seg['height'])]
+            cmd += shlex.split(self._encoder(hwaccel, hevc, threads))
+            cmd += ['-f', 'mp4', pj(seg['outdir'], seg['name']) + '.part']
+
+        console = run(cmd, capture_output=True)
+
+        for seg in segments:
+            self._finish(pj(seg['outdir'], seg['name']), console.returncode == 0)
+        if console.returncode != 0:
+            self._print_error(console)
+        return console
+
+    def split_video_copy(self, input, start, end, outdir, name, hwaccel=False, hevc=False, threads=None):
+        """Cut a verse copying the packets of the video, without encoding it again
+
+        Only for verses that need no side bars. Packets are copied from the
+        first keyframe of the verse on. The frames before that keyframe can't
+        be copied, since they need an earlier one, so they are encoded again
+        with the codec of the source and put in front of the rest ("smart
+        cut"). The encoder is set up like the source stream, and the joined
+        track is tagged avc3/hev1, so the parameter sets of both parts are
+        read from the stream. The audio of the whole verse is encoded again
+        in one piece, which keeps it in sync across the join.
+
+        Videos in other codecs, or whose stream the encoder can't match, and
+        verses without a keyframe, are encoded whole by :method:`split_video`.
+
+        :return: the finished process
+        """
+        codec, keyframes = probe_keyframes(input)
+        first = next((t for t in keyframes if t >= start - self.keyframe_tolerance), None)
+        stream = video_stream(input) or {}
+        encoder = self._head_encoder(stream, codec, hwaccel, threads) if codec in ('h264', 'hevc') else None
+        if encoder is None or first is None or first >= end:
+            return self.split_video(input, start, end, outdir, name, hwaccel=hwaccel, hevc=hevc, threads=threads)
+
+        os.makedirs(outdir, exist_ok=True)
+        bareoutput = pj(outdir, name)
+        prelude = ['ffmpeg', '-y', '-loglevel', 'warning', '-hide_banner']
+        metadata = ['-map_chapters', '-1',
+                    '-metadata', f'title={name}', '-metadata', 'genre=vbastianpc',
+                    '-metadata', 'comment=https://github.com/vbastianpc/jw-scripts']
+        # Just past the keyframe, so the seek doesn't go back to the one before it
+        seek = str(first + self.keyframe_tolerance)
+        if first - start <= self.keyframe_tolerance:
+            steps = [prelude + ['-ss', seek, '-i', input, '-t', str(end - first), '-c', 'copy']
+                     + metadata + ['-f', 'mp4', bareoutput + '.part']]
+            temporary = []
+        else:
+            head, tail, concat = bareoutput + '.head.ts', bareoutput + '.tail.ts', bareoutput + '.concat.txt'
+            temporary = [head, tail, concat]
+            with open(concat, 'w', encoding='utf-8') as f:
+                for file in (head, tail):
+                    f.write("file '" + file.replace("'", "'\\''") + "'\n")
+            timescale = stream.get('time_base', '').partition('/')[2]
+            steps = [
+                # Video only, the audio is cut in one piece below
+                prelude + ['-ss', str(start), '-i', input, '-t', str(first - start), '-an'] + encoder
+                + ['-f', 'mpegts', head],
+                prelude + ['-ss', seek, '-i', input, '-t', str(end - first), '-an', '-c:v', 'copy',
+                           '-bsf:v', codec + '_mp4toannexb', '-f', 'mpegts', tail],
+                prelude + ['-f', 'concat', '-safe', '0', '-i', concat,
+                           '-ss', str(start), '-t', str(end - start), '-i', input,
+                           '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', 'aac',
+                           # Parameter sets may change at the join, so they must be allowed in the stream
+                           '-tag:v', 'avc3' if codec == 'h264' else 'hev1']
+                + (['-video_track_timescale', timescale] if timescale.isdigit() else [])
+                + metadata + ['-f', 'mp4', bareoutput + '.part'],
+            ]
+
+        for cmd in steps:
+            console = run(cmd, capture_output=True)
+            if console.returncode != 0:
+                break
+        for file in temporary:
             try:
-                os.remove(bareoutput + '.part')
+                os.remove(file)
             except FileNotFoundError:
                 pass
 
-            err = console.stderr.decode('utf-8')
-            print(err)
-            if self.hwaccel and any(elem in err.casefold() for elem in ['cuda', 'cuvid', 'nvidia', 'hwaccel']):
-                print('\nTranscoding with hardware acceleration is not possible. '
-                      'It is probably due to one of these 3 cases:\n'
-                      '\t- You do not have a dedicated graphics card.\n'
-                      '\t- You do not have a compatible graphics card.\n'
-                      '\t- You don\'t have the Nvidia software installed.\n\n'
-                      'Please visit https://github.com/vbastianpc/jw-scripts/wiki/jw-signs-(E)'
-                )
-                
+        self._finish(bareoutput, console.returncode == 0)
+        if console.returncode != 0:
+            self._print_error(console)
         return console
 
-    def _verificaBordes(self, dir_file, start):
-        cmd = f'ffmpeg -y -hide_banner -ss {str(start + 0.5)} -i {dir_file} -vframes 1 -f image2pipe -'
-        console = run(shlex.split(cmd), capture_output=True)
+    def _verificaBordes(self, dir_file, starts):
+        """Find the side bar colors of the verses of a video
+
+        The first frames of up to :var:`single_pass_outputs` verses are taken
+        by one ffmpeg run, seeking each of them as an input of its own with a
+        single decoding thread, and read as raw RGB scaled to
+        :var:`probe_size`. A frame whose corner is black is a 4:3 picture
+        in a 16:9 frame, and its bars get the colors of the left and right
+        edges of the picture, the median of a region at each edge. Videos
+        that aren't 16:9, as the cached probe says, have no side bars.
+
+        :param starts: start time of every verse
+        :return: list with (colorleft, colorright) or False for every start,
+                 or None for the verses whose frames could not be read
+        """
+        if not starts:
+            return []
+        stream = video_stream(dir_file) or {}
+        aspect = stream.get('display_aspect_ratio', '16:9').split(':')
         try:
-            img = Image.open(io.BytesIO(console.stdout))
-        except:
-            return None
-        else:
-            self.current_height = ffprobe_height(dir_file)
-            rgb = img.getpixel((20, 20))
-
-            if rgb == (0, 0, 0):
-                delta = int(self.current_height * 4 / 3 * 0.03)  # 3% safe bandwith
-                x = int((self.current_height * 16 / 9 - self.current_height * 4 / 3) / 2) + delta
-                y = int(self.current_height / 2)
-                r, g, b = img.getpixel((x, y))
-                colorleft = format(r, '02X') + format(g, '02X') + format(b, '02X')
-
-                x = int(self.current_height * 16 / 9) - x
-                r, g, b = img.getpixel((x, y))
-                colorright = format(r, '02X') + format(g, '02X') + format(b, '02X')
-                color = (colorleft, colorright)
-            else:
-                color = False
-            return color
+            if abs(int(aspect[0]) / int(aspect[1]) - 16 / 9) > 0.05:
+                # Not a 16:9 frame, there is no room for side bars
+                return [False] * len(starts)
+        except (ValueError, IndexError, ZeroDivisionError):
+            pass
+        try:
+            duration = float(stream['duration'])
+        except (KeyError, ValueError):
+            duration = float('inf')
+        width, height = self.probe_size
+        # Region of the top left corner
+        margin = max(height // 36, 2)
+        # Inner edges of the 4:3 picture
+        delta = int(height * 4 / 3 * 0.03)  # 3% safe bandwith
+        x = int((width - height * 4 / 3) / 2) + delta
+        y0, y1 = int(height * 3 / 8), int(height * 5 / 8)
+
+        colors = []
+        # At most single_pass_outputs inputs per run, each one is a demuxer and a decoder
+        for n in range(0, len(starts), self.single_pass_outputs):
+            batch = starts[n:n + self.single_pass_outputs]
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-hide_banner']
+            for start in batch:
+                # A seek past the end gives no frame, and then none of them can be told apart
+                cmd += ['-threads', '1', '-ss', str(start + 0.5 if start + 0.5 < duration else start),
+                        '-i', dir_file]
+            graph = ''.join(f'[{k}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS,scale={width}:{height}[v{k}];'
+                            for k in range(len(batch)))
+            graph += ''.join(f'[v{k}]' for k in range(len(batch))) + f'concat=n={len(batch)}:v=1:a=0[out]'
+            cmd += ['-filter_complex', graph, '-map', '[out]', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+            console = run(cmd, capture_output=True)
+            if console.returncode != 0 or len(console.stdout) != len(batch) * height * width * 3:
+                colors += [None] * len(batch)
+                continue
+            frames = np.frombuffer(console.stdout, dtype=np.uint8).reshape(len(batch), height, width, 3)
+
+            def median(x0, x1, y0, y1):
+                region = frames[:, y0:y1, x0:x1].reshape(len(batch), -1, 3)
+                return np.median(region, axis=1).round().astype(int)
+
+            corner = median(margin, 3 * margin, margin, 3 * margin)
+            left = median(x - margin, x + margin, y0, y1)
+            right = median(width - x - margin, width - x + margin, y0, y1)
+            for k in range(len(batch)):
+                if corner[k].max() <= self.black_level:
+                    colors.append((''.join(format(c, '02X') for c in left[k]),
+                                   ''.join(format(c, '02X') for c in right[k])))
+                else:
+                    colors.append(False)
+        return colors
 
     def write_json(self, data):
         with open(self.dirdb, 'w', encoding='utf-8') as f: